@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+
+from preprocessing.data_utils import datetime2ns
+
+def _stream_arrays(sess, attr):
+    # (timestamps, values) of a series or (starts, ends) of intervals, int64 ns,
+    # from the compact stream if the session is compacted
+    compact = getattr(sess, "compact_streams", {}).get(attr)
+    if compact is None:
+        data = getattr(sess, attr)
+        if data is None:
+            return None
+        if isinstance(data, pd.Series):
+            return datetime2ns(data.index), np.asarray(data.values), False
+        return datetime2ns(data.start), datetime2ns(data.end), True
+    if compact.kind == "series":
+        return compact["t"], compact["value"], False
+    return compact["start"], compact["end"], True
+
+# sessions are laid out back to back on one time axis, each gets this span (ns)
+SESSION_SPAN = 2**46  # ~19.5 hours
+
+def _session_origins(sessions, attrs):
+    # earliest timestamp of every session over the given streams
+    origins = np.zeros(len(sessions), dtype=np.int64)
+    for i, sess in enumerate(sessions):
+        arrays = [_stream_arrays(sess, attr) for attr in attrs]
+        firsts = [arr[0].min() for arr in arrays if arr is not None and len(arr[0])]
+        origins[i] = min(firsts) if firsts else 0
+    return origins
+
+def _concat_sessions(sessions, attr, origins):
+    # all sessions' arrays in one sorted array on the shared session time axis
+    # (ns since the session origin + session index *SESSION_SPAN), so that
+    # sessions that overlap in time are still kept apart
+    t, other, sess_idx = [], [], []
+    for i, sess in enumerate(sessions):
+        arrays = _stream_arrays(sess, attr)
+        if arrays is None:
+            continue
+        shift = i*SESSION_SPAN - origins[i]
+        t.append(arrays[0] + shift)
+        # interval ends are timestamps as well
+        other.append(arrays[1] + shift if arrays[2] else arrays[1])
+        sess_idx.append(np.full(len(arrays[0]), i, dtype=np.int32))
+    if not t:
+        return None
+    t, other, sess_idx = np.concatenate(t), np.concatenate(other), np.concatenate(sess_idx)
+    order = np.argsort(t, kind='stable')
+    return t[order], other[order], sess_idx[order]
+
+def _as_sessions(sessions):
+    # a single session, a list of sessions or a MarmosetDataset
+    if hasattr(sessions, "compact_streams"):
+        return [sessions]
+    return list(getattr(sessions, "sessions", sessions))
+
+def reward_lick_latencies(sessions, max_latency=None):
+    """
+    Latency from every reward to the first lick onset after it.
+
+    All sessions are concatenated into single sorted arrays, the first lick of
+    every reward is found with one searchsorted call. Licks of another session
+    never count.
+
+    Args:
+    - sessions (MarmosetDataset, list or MarmosetSessionData): Sessions.
+    - max_latency (float, optional): Latencies above this (seconds) are NaN.
+
+    Returns:
+    - pd.DataFrame: One row per reward, columns `session` (index into
+      sessions), `reward_time` and `latency` (seconds, NaN without lick).
+    """
+    sessions = _as_sessions(sessions)
+    origins = _session_origins(sessions, ("reward_data", "lick_data"))
+    rewards = _concat_sessions(sessions, "reward_data", origins)
+    licks = _concat_sessions(sessions, "lick_data", origins)
+    return _reward_events(rewards, licks, origins, max_latency)
+
+def _reward_events(rewards, licks, origins, max_latency):
+    if rewards is None:
+        return pd.DataFrame({"session": np.empty(0, dtype=np.int32),
+                             "reward_time": np.empty(0, dtype="datetime64[ns]"),
+                             "latency": np.empty(0)})
+    reward_t, _, reward_sess = rewards
+
+    latency = np.full(len(reward_t), np.nan)
+    if licks is not None and len(licks[0]):
+        lick_starts, _, lick_sess = licks
+        first_lick = np.searchsorted(lick_starts, reward_t, side='left')
+        has_lick = first_lick < len(lick_starts)
+        first_lick = np.minimum(first_lick, len(lick_starts)-1)
+        has_lick &= lick_sess[first_lick] == reward_sess
+        latency[has_lick] = (lick_starts[first_lick[has_lick]]
+                             -reward_t[has_lick]) /1e9
+        if max_latency is not None:
+            latency[latency > max_latency] = np.nan
+
+    # back from the session time axis to timestamps
+    reward_time = reward_t - reward_sess.astype(np.int64)*SESSION_SPAN + origins[reward_sess]
+    return pd.DataFrame({"session": reward_sess,
+                         "reward_time": reward_time.view("datetime64[ns]"),
+                         "latency": latency})
+
+def peri_event_windows(event_t, event_sess, stream, pre, post, bin_size,
+                       intervals=False):
+    """
+    Sample a stream in a window around every event.
+
+    The windows of all events are one (n_events, n_bins) grid of timestamps,
+    the stream is sampled at all of them with one searchsorted call: a time
+    series holds its last sample (NaN before the first sample of the event's
+    session), an interval stream is 1 inside an interval and 0 outside.
+
+    Args:
+    - event_t (np.ndarray): Event timestamps, int64 ns.
+    - event_sess (np.ndarray): Session index of every event.
+    - stream (tuple): (timestamps, values, session index) of a series or
+      (starts, ends, session index) of intervals, sorted by time. Timestamps
+      on the same axis as `event_t`.
+    - pre, post (float): Window before and after the event in seconds.
+    - bin_size (float): Bin size in seconds.
+    - intervals (bool): Whether `stream` is an interval stream.
+
+    Returns:
+    - tuple: Bin offsets in seconds, float32 array of shape (n_events, n_bins).
+    """
+    offsets = np.arange(-pre, post+bin_size/2, bin_size)
+    windows = np.full((len(event_t), len(offsets)), np.nan, dtype=np.float32)
+    if stream is None or not len(stream[0]) or not len(event_t):
+        return offsets, windows
+
+    t, other, sess = stream
+    grid = event_t[:, None] + np.round(offsets *1e9).astype(np.int64)[None, :]
+    last = np.searchsorted(t, grid, side='right') -1
+    valid = last >= 0
+    last = np.maximum(last, 0)
+    if intervals:
+        # inside an interval of the event's session, otherwise 0
+        windows[:] = valid & (other[last] >= grid) & (sess[last] == event_sess[:, None])
+    else:
+        valid &= sess[last] == event_sess[:, None]
+        windows[valid] = other[last[valid]]
+    return offsets, windows
+
+def reward_aligned(sessions, pre=2, post=5, bin_size=.05, max_latency=None):
+    """
+    Reward aligned lick state and distance of all sessions at once.
+
+    Args:
+    - sessions (MarmosetDataset, list or MarmosetSessionData): Sessions.
+    - pre, post (float): Window before and after every reward in seconds.
+    - bin_size (float): Bin size in seconds.
+    - max_latency (float, optional): Max. reward to lick latency in seconds.
+
+    Returns:
+    - dict: `events` (DataFrame from `reward_lick_latencies`), `offsets` (bin
+      offsets in seconds), `lick` and `distance` (float32 arrays of shape
+      (n_rewards, n_bins)).
+    """
+    sessions = _as_sessions(sessions)
+    origins = _session_origins(sessions, ("reward_data", "lick_data", "dist_left_data"))
+    rewards = _concat_sessions(sessions, "reward_data", origins)
+    licks = _concat_sessions(sessions, "lick_data", origins)
+    dist = _concat_sessions(sessions, "dist_left_data", origins)
+    events = _reward_events(rewards, licks, origins, max_latency)
+    
+    event_t, event_sess = (rewards[0], rewards[2]) if rewards is not None \
+                          else (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32))
+    offsets, lick = peri_event_windows(event_t, event_sess, licks, pre, post,
+                                       bin_size, intervals=True)
+    _, distance = peri_event_windows(event_t, event_sess, dist, pre, post, bin_size)
+    return {"events": events, "offsets": offsets, "lick": lick, "distance": distance}
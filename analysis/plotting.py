@@ -3,11 +3,62 @@ import matplotlib.dates as mdates
 import matplotlib.patches as mpatches
 import matplotlib.colors as mcolors
 import matplotlib.gridspec as gridspec
+from matplotlib.collections import LineCollection
 import numpy as np
 import pandas as pd
 
-
-def plot_session_timeline(data):
+from analysis.event_alignment import reward_lick_latencies
+
+def decimate_minmax(x, y, x_min, x_max, n_buckets):
+    """
+    Min/max decimation of a sorted series for plotting.
+
+    The visible range [x_min, x_max] is split into `n_buckets` (about one per
+    pixel), each bucket is represented by its minimum and maximum, so the line
+    looks the same as when plotting every sample.
+
+    Args:
+    - x (np.ndarray): Sorted x values.
+    - y (np.ndarray): y values.
+    - x_min, x_max (float): Visible x range.
+    - n_buckets (int): Number of buckets.
+
+    Returns:
+    - tuple: Decimated x and y arrays.
+    """
+    # one sample outside the visible range on each side for continuous lines
+    start = max(np.searchsorted(x, x_min, side='left') -1, 0)
+    stop = min(np.searchsorted(x, x_max, side='right') +1, len(x))
+    x, y = x[start:stop], y[start:stop]
+    if len(x) <= 4*n_buckets:
+        return x, y
+    
+    bucket_edges = np.linspace(x[0], x[-1], n_buckets+1)
+    bucket_starts = np.unique(np.searchsorted(x, bucket_edges[:-1], side='left'))
+    bucket_ends = np.append(bucket_starts[1:], len(x)) -1
+    y_min = np.fmin.reduceat(y, bucket_starts)
+    y_max = np.fmax.reduceat(y, bucket_starts)
+    x_dec = np.column_stack([x[bucket_starts], x[bucket_ends]]).ravel()
+    y_dec = np.column_stack([y_min, y_max]).ravel()
+    return x_dec, y_dec
+
+def plot_decimated(ax, series, **kwargs):
+    # plot a long time series, redecimated to the axis width on every zoom
+    x = mdates.date2num(series.index.values)
+    y = np.asarray(series.values, dtype=float)
+    line, = ax.plot(x[:1], y[:1], **kwargs)
+    ax.update_datalim(np.column_stack([x[[0, -1]], [np.nanmin(y), np.nanmax(y)]]))
+    ax.xaxis_date()
+
+    def update(ax):
+        x_min, x_max = ax.get_xlim()
+        n_buckets = max(int(ax.bbox.width), 1)
+        line.set_data(*decimate_minmax(x, y, x_min, x_max, n_buckets))
+    update(ax)
+    ax.callbacks.connect('xlim_changed', update)
+    return line
+
+def plot_session_timeline(data, decimate=True):
     # Create a Matplotlib figure with 3 subplots
     # fig = plt.figure()  # Adjust the figure size as needed
     fig, axes = plt.subplots(figsize=(18, 8), nrows=len(data), height_ratios=[2, 1, 2, 2, 2], sharex=True)
@@ -22,9 +73,14 @@ def plot_session_timeline(data):
         [ax.spines[s].set_visible(False) for s in ['top', 'right', 'bottom']]
         # Add vertical grid lines
         ax.grid(axis='x', linestyle='--', alpha=0.7)
+        if data[i] is None:
+            continue
         
         if i == 0:
-            ax.plot(data[i].index, data[i], linewidth=.7, alpha=.8)
+            if decimate:
+                plot_decimated(ax, data[i], linewidth=.7, alpha=.8)
+            else:
+                ax.plot(data[i].index, data[i], linewidth=.7, alpha=.8)
             ax.set_yscale("log")    
             ax.set_ylabel("distance sensor [cm]")
             ax.axhline(y=6, color='r', linestyle='--', label='reward threshold')
@@ -35,17 +91,26 @@ def plot_session_timeline(data):
             # ax.plot(data[i].index-data[i].index[0], data[i], alpha=.5)
             # ax.set_yticklabels([])
         if i == 2:
-            for i,row in data[i].iterrows():
-                ax.plot(row.drop("duration"), (1,1), alpha=.5, linewidth=3)
+            # all licks as one collection, colors cycle like separate lines
+            starts = mdates.date2num(data[i].start.values)
+            ends = mdates.date2num(data[i].end.values)
+            segments = np.stack([np.column_stack([starts, np.ones_like(starts)]),
+                                 np.column_stack([ends, np.ones_like(ends)])], axis=1)
+            colors = [f"C{j%10}" for j in range(len(segments))]
+            ax.add_collection(LineCollection(segments, colors=colors, alpha=.5, 
+                                             linewidth=3))
+            ax.xaxis_date()
+            ax.autoscale_view()
             ax.set_xlabel('Time')
             ax.set_ylabel("lick sensor")
             ax.set_yticklabels([])
 
         if i == 3:
-            for t,onoff in data[i].iteritems():
-                color = 'red' if onoff == -1 else 'green'
-                t_datetime = pd.to_datetime(t, unit='s')  # Convert Unix timestamp to datetime
-                axes[0].hlines(y=1.5, xmin=t_datetime, xmax=t_datetime + pd.Timedelta(minutes=4), color=color, linewidth=4)
+            # Convert Unix timestamps to datetime
+            t_datetime = pd.to_datetime(data[i].index.values, unit='s')
+            colors = np.where(data[i].values == -1, 'red', 'green')
+            axes[0].hlines(y=np.full(len(t_datetime), 1.5), xmin=t_datetime, xmax=t_datetime + pd.Timedelta(minutes=4), 
+                           colors=colors, linewidth=4)
 
         if i == 4:
             ax.plot(data[i].index, np.cumsum(data[i]*.04), alpha=.8) 
@@ -61,9 +126,11 @@ def plot_session_timeline(data):
     plt.show()
 
 
-def plot_reward2lick_hist(session_data):
+def plot_reward2lick_hist(session_data, max_latency=None):
+    # session_data: session, list of sessions or dataset
+    latencies = reward_lick_latencies(session_data, max_latency).latency.dropna()
     # Create a histogram
-    hist, bins = np.histogram(session_data.reward_deltatimes, bins=30, density=True)
+    hist, bins = np.histogram(latencies, bins=30, density=True)
 
     # Calculate the cumulative distribution
     cumulative = np.cumsum(hist) * np.diff(bins)
@@ -73,7 +140,7 @@ def plot_reward2lick_hist(session_data):
     plt.axvline(x=3, color='r', linestyle='--', label='max reward freq.')
 
     # Add labels and a legend
-    # plt.xlabel(session_data.reward_deltatimes.name)
+    plt.xlabel('Reward to first lick latency [s]')
     plt.ylabel('Cumulative Probability')
     plt.ylim(0, 1)
     plt.legend()
@@ -81,26 +148,37 @@ def plot_reward2lick_hist(session_data):
     # Show the plot
     plt.show()
 
+def _sessions_overview_data(sessions):
+    # (day, start time, duration, n rewards, rewards/min) per session
+    if isinstance(sessions, pd.DataFrame):
+        # session catalog rows, no session data needs to be loaded
+        has_rewards = sessions.streams.str.split(";").apply(lambda s: "reward_data" in s)
+        return [(r.session_start.date(), r.session_start.time(), r.session_length,
+                 r.n_reward_events if has_rew else None, r.reward_events_per_min)
+                for r, has_rew in zip(sessions.itertuples(), has_rewards)]
+    
+    return [(s.session_start_date, s.session_start_time, s.session_length,
+             s.n_reward_events if s.reward_data is not None else None,
+             s.reward_events_per_min if s.reward_data is not None else None)
+            for s in sessions]
+
 def plot_sessions_overview(sessions, reward_colored=True):
+    # sessions: list of MarmosetSessionData or the dataset session catalog
 
     # Create a figure and axis
     fig, ax = plt.subplots(figsize=(16, 3))
 
-    for sess in sessions:
-        day = sess.session_start_date
-        start_time = sess.session_start_time
-        duration = sess.session_length
-
+    for day, start_time, duration, n_rewards, rewards_per_min in _sessions_overview_data(sessions):
         height = duration.total_seconds() / 3600
         bottom = start_time.hour+start_time.minute/60
         if reward_colored:
-            if sess.reward_data is None:
+            if n_rewards is None:
                 continue
             cmap = plt.get_cmap('binary')  # You can replace 'viridis' with any other valid colormap name
             norm = mcolors.Normalize(vmin=0, vmax=7)
-            color = cmap(norm(sess.reward_events_per_min))
+            color = cmap(norm(rewards_per_min))
         else:
-            color = 'green' if sess.reward_data is not None and sess.n_reward_events>1 else "gray"
+            color = 'green' if n_rewards is not None and n_rewards>1 else "gray"
         ax.bar(day, height, bottom=bottom, width=0.8, alpha=0.7, color=color)
 
     # Set axis labels
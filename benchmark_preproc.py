@@ -0,0 +1,126 @@
+import argparse
+import os
+import time
+import shutil
+import logging
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from preprocessing.MarmosetSessionData import MarmosetSessionData
+from preprocessing.synthetic_session import write_synthetic_session
+from preprocessing.data_io import read_metadata_file
+from preprocessing.data_io import read_sensor_file
+from preprocessing.video_utils import write_facecam_vid
+
+from general_modules.config import *
+
+def time_stage(func, *args, trace_memory=False):
+    # wall time, CPU time and peak traced (python + numpy) memory of one call,
+    # tracing slows down python heavy stages a lot, so it's optional
+    if trace_memory:
+        tracemalloc.start()
+    t0, c0 = time.perf_counter(), time.process_time()
+    result = func(*args)
+    wall_s, cpu_s = time.perf_counter()-t0, time.process_time()-c0
+    peak_mb = np.nan
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] /2**20
+        tracemalloc.stop()
+    return result, {"wall_s": wall_s, "cpu_s": cpu_s, "peak_mb": peak_mb}
+
+def benchmark_session(session_path, tmp_path, trace_memory):
+    sess = MarmosetSessionData.__new__(MarmosetSessionData)
+    sess.metad = read_metadata_file(session_path)
+    sess.data_path = session_path
+    sess._preproc_path = None
+
+    stats = []
+    def run(stage, n_items, func, *args):
+        result, stage_stats = time_stage(func, *args, trace_memory=trace_memory)
+        n_items = n_items(result) if callable(n_items) else n_items
+        stats.append({"stage": stage, "n_items": n_items, **stage_stats,
+                      "items_per_s": n_items/stage_stats["wall_s"]})
+        return result
+
+    sensor_data = run("read_sensor_file", lambda d: sum(map(len, d.values())),
+                      read_sensor_file, session_path, sess.logger)
+    photores_d, lick_d, dist_left_d = sess._extract_sensors(sensor_data)
+    sess.expframe_ts_data = run("_preproc_photores_data", len(photores_d),
+                                sess._preproc_photores_data, photores_d)
+    sess.lick_data = run("_preproc_lick_data", len(lick_d),
+                         sess._preproc_lick_data, lick_d)
+    sess.dist_left_data = run("_preproc_dist_data", len(dist_left_d),
+                              sess._preproc_dist_data, dist_left_d)
+    sess._process_reward_data(session_path)
+    for cam in ("frontcam", "scenecam", "facecam"):
+        sess._process_cam_ts_data(session_path, cam)
+
+    lick_frames = run("_get_lickframes", len(sess.facecam_ts),
+                      sess._get_lickframes, sess.facecam_ts)
+    run("alignment", len(sess.facecam_ts), sess._process_alignment)
+    run("write_facecam_vid", len(sess.facecam_ts), write_facecam_vid,
+        os.path.join(session_path, FACE_CAM_FNAME), sess.facecam_ts, lick_frames,
+        sess._get_rewardframes(sess.facecam_ts), tmp_path, FACECAM_VID_OUTFNAME,
+        sess.logger)
+
+    n_samples = sum(map(len, sensor_data.values()))
+    preproc_path = os.path.join(tmp_path, "preproc_benchmark")
+    run("save", n_samples, sess._save_prepoc_data, preproc_path, session_path,
+        list(PREPROC_STAGES))
+    loaded = MarmosetSessionData.__new__(MarmosetSessionData)
+    loaded._preproc_path = preproc_path
+    run("load", n_samples, loaded._load_prepoc_data)
+    return stats
+
+def main(lengths_min, data_path, baseline_fname, output_fname, trace_memory):
+    logging.disable(logging.INFO)
+
+    results = []
+    for length_min in lengths_min:
+        session_path = os.path.join(data_path, f"{length_min}min", "2023-10-05",
+                                    "09-00-00")
+        if not os.path.exists(os.path.join(session_path, "metadata.json")):
+            print(f"Writing synthetic {length_min} min session...")
+            write_synthetic_session(session_path, length_min=length_min)
+
+        tmp_path = tempfile.mkdtemp()
+        try:
+            stats = benchmark_session(session_path, tmp_path, trace_memory)
+        finally:
+            shutil.rmtree(tmp_path)
+        results.extend({"length_min": length_min, **s} for s in stats)
+
+    results = pd.DataFrame(results)
+    if baseline_fname is not None:
+        baseline = pd.read_csv(baseline_fname)
+        results = results.merge(baseline[["length_min", "stage", "wall_s"]],
+                                on=["length_min", "stage"], how="left",
+                                suffixes=("", "_baseline"))
+        results["speedup"] = results.wall_s_baseline / results.wall_s
+
+    with pd.option_context("display.max_rows", None, "display.max_columns", None,
+                           "display.width", 200):
+        print(results.round(3))
+    if output_fname is not None:
+        results.to_csv(output_fname, index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the preprocessing stages "
+                                     "on synthetic sessions of different length.")
+    parser.add_argument("--lengths", type=float, nargs='+', default=[1, 5, 20],
+                        help="session lengths in minutes")
+    parser.add_argument("--data_path", type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             "marmoset_benchmark_data"),
+                        help="where synthetic sessions are written (and reused)")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="CSV of a previous run to compute speedups against")
+    parser.add_argument("--output", type=str, default=None,
+                        help="write the results to this CSV file")
+    parser.add_argument("--memory", action="store_true",
+                        help="trace peak memory per stage (slows down the stages)")
+    args = parser.parse_args()
+
+    main(args.lengths, args.data_path, args.baseline, args.output, args.memory)
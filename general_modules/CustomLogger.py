@@ -1,6 +1,16 @@
 import os
+import io
+import time
 import logging
 import datetime
+import functools
+import contextlib
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS isn't measured there
+    resource = None
 
 import general_modules.config as config
 
@@ -12,6 +22,9 @@ class CustomLogger:
     - Create an instance with a desired name and optional log file directory.
     - Use the provided methods to log messages at different levels.
     - Call the 'spacer' method to insert a separator line in the log.
+    - Use 'profile' (context manager) or 'profiled' (decorator) to measure the
+      wall time, CPU time and memory of a code block.
+    - Use 'capture' to collect messages (down to debug level) in a buffer.
 
     Attributes:
     - name (str): The name of the logger, typically corresponding to the module or script.
@@ -39,12 +52,14 @@ class CustomLogger:
         self._default_file_fmtr = self._create_formatter(file_fmt)
 
         self._console_hdlr = self._create_console_logger()
+        self._console_hdlr.setLevel(config.LOGGING_LEVEL)
         self._logger.addHandler(self._console_hdlr)
 
         self._file_hdlr = None
         if write_to_directory is not None:
             self._file_hdlr = self._create_logfile_handler(write_to_directory)
             self._logger.addHandler(self._file_hdlr)
+        self._capture_hdlrs = []
         
     def _create_formatter(self, fmt):
         return logging.Formatter(fmt)
@@ -71,6 +86,7 @@ class CustomLogger:
             
             file_handler = logging.FileHandler(log_fullfname)
             file_handler.setFormatter(self._default_file_fmtr)
+            file_handler.setLevel(config.LOGGING_LEVEL)
             return file_handler
         
         except FileNotFoundError as e:
@@ -87,6 +103,7 @@ class CustomLogger:
         else:
             fmts = (self._default_console_fmtr, self._default_file_fmtr)
             [han.setFormatter(fmt) for han, fmt in zip(self._logger.handlers, fmts)]
+            [han.setFormatter(self._default_file_fmtr) for han in self._capture_hdlrs]
 
     def extend_fmt(self, exten):
         console_fmt = config.CONSOLE_LOGGING_FMT + exten + config.LOGGING_FMT_MSG
@@ -97,6 +114,7 @@ class CustomLogger:
         self._console_hdlr.setFormatter(self._default_console_fmtr)
         if self._file_hdlr is not None:
             self._file_hdlr.setFormatter(self._default_file_fmtr)
+        [han.setFormatter(self._default_file_fmtr) for han in self._capture_hdlrs]
 
     def spacer(self):
         """
@@ -159,6 +177,105 @@ class CustomLogger:
         else:
             log_func(msg)
 
+    @contextlib.contextmanager
+    def capture(self, level=logging.DEBUG):
+        """
+        Context manager that additionally writes all messages of `level` and 
+        above to a buffer, e.g. to save a debug log next to some output. The
+        console and file handlers keep their level.
+
+        Args:
+        - level (int): Lowest level that is captured.
+
+        Yields:
+        - io.StringIO: The buffer with the formatted messages.
+        """
+        buffer = io.StringIO()
+        handler = logging.StreamHandler(buffer)
+        handler.setLevel(level)
+        handler.setFormatter(self._default_file_fmtr)
+        prev_level = self._logger.level
+        self._logger.setLevel(min(level, prev_level))
+        self._logger.addHandler(handler)
+        self._capture_hdlrs.append(handler)
+        try:
+            yield buffer
+        finally:
+            self._capture_hdlrs.remove(handler)
+            self._logger.removeHandler(handler)
+            self._logger.setLevel(prev_level)
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """
+        Context manager that measures a code block, e.g. a preprocessing stage,
+        and logs the measurements at debug level.
+
+        Measured are the wall time, the CPU time of the calling thread, the 
+        process peak RSS and by how much the block increased it, and, if 
+        `config.PROFILE_TRACEMALLOC` is set, the peak traced memory. The 
+        memory values are process wide, they include concurrently running code.
+
+        Args:
+        - name (str): Name of the profiled block.
+
+        Yields:
+        - dict: The measurements, filled in when the block exits.
+        """
+        record = {}
+        if config.PROFILE_TRACEMALLOC:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        rss_start = _peak_rss_mb()
+        t0, c0 = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() -t0
+            record["cpu_time"] = time.thread_time() -c0
+            record["peak_rss_mb"] = _peak_rss_mb()
+            record["peak_rss_increase_mb"] = None
+            if rss_start is not None:
+                record["peak_rss_increase_mb"] = record["peak_rss_mb"] -rss_start
+            msg = (f"Profiled `{name}`: {record['wall_time']:.3f}s wall, "
+                   f"{record['cpu_time']:.3f}s CPU")
+            if rss_start is not None:
+                msg += (f", peak RSS {record['peak_rss_mb']:.1f}MB "
+                        f"(+{record['peak_rss_increase_mb']:.1f}MB)")
+            if config.PROFILE_TRACEMALLOC:
+                traced_peak = tracemalloc.get_traced_memory()[1] -traced_start
+                record["tracemalloc_peak_mb"] = traced_peak /2**20
+                msg += f", traced peak {record['tracemalloc_peak_mb']:.1f}MB"
+            self.debug(msg)
+
+    def profiled(self, name=None):
+        """
+        Decorator version of `profile`, the measurements of the last call are 
+        stored in the `last_profile` attribute of the wrapper.
+
+        Args:
+        - name (str, optional): Name of the profiled block, defaults to the 
+          function name.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.profile(name or func.__qualname__) as record:
+                    wrapper.last_profile = record
+                    return func(*args, **kwargs)
+            wrapper.last_profile = None
+            return wrapper
+        return decorator
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return maxrss /2**20 if os.uname().sysname == "Darwin" else maxrss /2**10
+
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import os
 import logging 
 
 LOGGING_LEVEL = logging.INFO
@@ -7,10 +8,18 @@ LOGGING_FMT_MSG = f'\n\t%(message)s'
 SPACER_LOGGING_FMT = f'%(message)s=====================================================\n'
 LOG_TO_DIR = './logs'
 LOG_TO_DIR = None
+# trace python/numpy allocations when profiling stages, slows down python code
+PROFILE_TRACEMALLOC = False
 
 SENSOR_DATA_FNAME = "sensor_data.csv"
 REWARD_DATA_FNAME = "reward.log"
 
+SENSOR_CSV_CHUNKSIZE = 1_000_000  # rows parsed at once
+SENSOR_CSV_DROP_COLUMNS = ("computer_timestamp",)
+SENSOR_CSV_TIMESTAMP_COLUMN = "logging_timestamp"
+# only used to tell samples logged in the same batch apart from duplicates
+SENSOR_CSV_ARDUINO_TS_COLUMN = "arduino_timestamp"
+
 PHTOTRES_SENSOR_ID = "photoResistor"
 LICK_SENSOR_ID = "lickSensor"
 DISTANCELEFT_SENSOR_ID = "distanceSensorLeft"
@@ -30,23 +39,117 @@ ONOFF_OUTFNAME = "onwoff_switches"
 FRONTCAM_TS_OUTFNAME = "frontcam_ts"
 SCENECAM_TS_OUTFNAME = "scenecam_ts"
 FACECAM_TS_OUTFNAME = "facecam_ts"
+FRONTCAM_ALIGNMENT_OUTFNAME = "frontcam_alignment"
+SCENECAM_ALIGNMENT_OUTFNAME = "scenecam_alignment"
+FACECAM_ALIGNMENT_OUTFNAME = "facecam_alignment"
 
-FACECAM_VID_OUTFNAME = "facecam_annotated"
-VIDEO_FILE_ENDING = ".avi"
+# preprocessing cache, bump the version when preprocessed outputs change 
+PREPROC_VERSION = 7
+PREPROC_DIR_PREFIX = "preproc_"
+PREPROC_MANIFEST_FNAME = "manifest.json"
+PREPROC_REPORT_FNAME = "preproc_report.json"
+PREPROC_LOG_FNAME = "preproc.log"  # debug level log of the preprocessing run
+FINGERPRINT_HASH_BLOCKSIZE = 2**20  # raw files are hashed in blocks of 1 MB
 
-#                 Y   X  WIDTH
-FACE_CAM_CROP = (120,250,200)
-FACE_CAM_FLIP = True
+# preprocessing stages with the raw files/metadata they depend on
+PREPROC_STAGES = {
+    "sensor": {"inputs": (SENSOR_DATA_FNAME,),
+               "params": ("dist_sensor_mean_windowsize", "dist_sensor_window_ms",
+                          "dist_sensor_filter"),
+               "outputs": (EXPFRAME_TS_OUTFNAME, LICK_OUTFNAME, DIST_LEFT_OUTFNAME)},
+    "reward": {"inputs": (REWARD_DATA_FNAME,),
+               "params": (),
+               "outputs": (REWARD_OUTFNAME, ONOFF_OUTFNAME)},
+    "video_ts": {"inputs": (FRONT_CAM_TS_FNAME, SCENE_CAM_TS_FNAME, FACE_CAM_TS_FNAME,
+                            FRONT_CAM_FNAME, SCENE_CAM_FNAME, FACE_CAM_FNAME),
+                 "params": ("cameraFPS",),
+                 "outputs": (FRONTCAM_TS_OUTFNAME, SCENECAM_TS_OUTFNAME, 
+                             FACECAM_TS_OUTFNAME)},
+    # camera frames -> sensor samples, events and other cameras' frames
+    "alignment": {"inputs": (SENSOR_DATA_FNAME, REWARD_DATA_FNAME, FRONT_CAM_TS_FNAME,
+                             SCENE_CAM_TS_FNAME, FACE_CAM_TS_FNAME),
+                  "params": ("cameraFPS",),
+                  "outputs": (FRONTCAM_ALIGNMENT_OUTFNAME, SCENECAM_ALIGNMENT_OUTFNAME,
+                              FACECAM_ALIGNMENT_OUTFNAME)},
+}
 
-# LOG_OOD_DELTATIMES = False
+# one row per session, stored in the dataset root directory
+SESSION_CATALOG_FNAME = "session_catalog.csv"
+
+# consolidated dataset store, one directory per day with one columnar 
+# partition (like a preproc directory) per session and the day's catalog
+DATASET_STORE_META_FNAME = "dataset_store.json"
+DATASET_STORE_SESSION_FNAME = "session.json"
+DATASET_STORE_VERSION = 1
 
+# columnar preprocessed data store, one directory of .npy arrays per output
+PREPROC_LAYOUT_FNAME = "layout.json"
+PREPROC_STORE_COMPRESS = False  # compressed .npz, can't be memory-mapped
+PREPROC_STORE_MMAP = True
 
-"""
-Feature requests:
+# distance sensor smoothing, `dist_sensor_window_ms` and `dist_sensor_filter` 
+# in the session metadata take precedence. Without a window length the window 
+# is `dist_sensor_mean_windowsize` median sampling intervals long, estimated
+# from the first samples. The sensor is filtered chunk by chunk while reading
+DIST_SENSOR_FILTER = "mean"  # mean, median or min
+DIST_SENSOR_FILTER_CHUNKSIZE = 1_000_000
+DIST_SENSOR_WINDOW_EST_SAMPLES = 1000
 
-have a preprocessing log at debug level written to a file that is part of the
-preproc final dir
+# photoresistor frame render detection, the threshold adapts to the signal 
+# range in consecutive time blocks, blocks with a smaller range are ignored
+PHOTORES_BLOCK_MS = 1000
+PHOTORES_HYSTERESIS = .2  # fraction of the half range around the midpoint
+PHOTORES_MIN_AMPLITUDE = 10
+PHOTORES_DEBOUNCE_MS = 3  # shorter renders and gaps are dropped/merged
+PHOTORES_CHUNKSIZE = 1_000_000
 
+# timestamp integrity: timestamps further than this from the session are 
+# corrupt, delta time statistics come from a histogram (larger deltas overflow)
+TS_MAX_OFFSET_S = 24*3600
+TS_DELTA_HIST_RESOLUTION_US = 10
+TS_DELTA_HIST_MAX_MS = 1000
+# sensor rows with corrupt timestamps are interpolated ("repair") or dropped 
+# ("drop"), non-monotonic and duplicate rows dropped, None only reports them
+SENSOR_TS_REPAIR = "repair"
 
+# follow mode (running sessions), max. bytes read from a raw file at once and
+# the update interval of the live metrics
+LIVE_MAX_READ_BYTES = 64*2**20
+LIVE_POLL_INTERVAL_S = 2
 
-"""
\ No newline at end of file
+# local cache directory for metadata that is expensive to get from the NAS
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "marmosetAnalysis")
+VIDEO_PROBE_CACHE_FNAME = "video_probe_cache.json"
+# local (SSD) staging cache for raw session files on the NAS, files are copied
+# on first read and evicted least recently used first, None disables it
+STAGING_CACHE_DIR = None
+STAGING_CACHE_MAX_GB = 200
+STAGING_LOCK_FNAME = ".lock"  # held while checking/evicting, by all processes
+STAGING_PIN_FNAME = ".pin"  # shared lock of the readers of an entry
+STAGING_SIZE_FNAME = ".size"  # size reserved by an entry, also while copying
+STAGING_COPY_FNAME = ".copy"  # held while copying, one copy per entry at a time
+# directory tree of a dataset, validated with directory mtimes on the next scan
+SCAN_MANIFEST_FNAME = "scan_manifest_{}.json"  # hash of the dataset path
+SCAN_MANIFEST_VERSION = 1
+SCAN_SKIP_DIRS = ("tobiiImgs",)
+
+FACECAM_VID_OUTFNAME = "facecam_annotated"
+VIDEO_FILE_ENDING = ".avi"
+
+# threads for running independent stages of a session concurrently
+SESSION_STAGE_N_WORKERS = 4
+WRITE_FACECAM_VID = False
+
+# annotated video writer pipeline: decode thread -> annotate workers -> encode
+VIDEO_WRITER_N_WORKERS = 4
+VIDEO_WRITER_QUEUE_SIZE = 64  # max. frames in flight
+REWARD_ANNOTATION_LOOKAHEAD = 10  # frames before a reward labeled as reward
+# random frame access, frames further ahead are reached by seeking
+VIDEO_FRAME_CACHE_MB = 512
+VIDEO_MAX_FORWARD_DECODE = 120
+
+#                 Y   X  WIDTH
+FACE_CAM_CROP = (120,250,200)
+FACE_CAM_FLIP = True
+
+# LOG_OOD_DELTATIMES = False
@@ -1,10 +1,11 @@
 import argparse
-import pickle
+import time
 # import preprocessing
 from preprocessing.MarmosetSessionData import MarmosetSessionData
 from preprocessing.MarmosetDataset import MarmosetDataset
 # from preprocessing import plotting
 import analysis.plotting as plotting
+from general_modules.config import LIVE_POLL_INTERVAL_S
 
 if __name__ == "__main__":
 
@@ -14,10 +15,8 @@ if __name__ == "__main__":
     #                 #               "2023-09-05", ], 
     #                 # only_days=["2023-08-24"], 
     #                 use_precomp=False)
-    # with open('dataset_tmp.pkl', 'wb') as file:
-    #     pickle.dump(tmp, file)
-    # with open('dataset_tmp.pkl', 'rb') as file:
-    #     tmp = pickle.load(file)
+    # tmp.save('dataset_store')
+    # tmp = MarmosetDataset.load('dataset_store', only_days=["2023-08-24"])
     
     # dates = set([d.start_date for d in tmp.sessions])
     # exit()
@@ -27,8 +26,19 @@ if __name__ == "__main__":
     parser.add_argument("data_path", type=str, nargs='?', 
                         default="/mnt/NTnas/MarmosetBehavior/Data/2024-03-19/08-15-30/", 
                         help="relative path to recording day")
+    parser.add_argument("--follow", action="store_true",
+                        help="follow a running session and log its metrics")
     args = parser.parse_args()
 
+    if args.follow:
+        s = MarmosetSessionData(args.data_path, readwrite_preproc="follow")
+        try:
+            while True:
+                s.logger.info([f"{key}: {value}" for key, value in s.update().items()])
+                time.sleep(LIVE_POLL_INTERVAL_S)
+        except KeyboardInterrupt:
+            exit()
+
     s = MarmosetSessionData(args.data_path, readwrite_preproc="read")
     plotting.plot_session_timeline((s.dist_left_data, s.reward_data, s.lick_data, 
                                     s.onoff_swtiches, s.reward_data))
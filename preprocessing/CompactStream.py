@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+from .data_utils import datetime2ns
+
+class CompactStream:
+    """
+    Array-backed, memory efficient representation of a session stream.
+
+    Time series (sensor samples, reward events, ON/OFF switches) are stored as
+    a contiguous int64 nanosecond timestamp array `t` and a `value` array of
+    the smallest fitting dtype (bool, int8, int16, or float32). Interval tables
+    (licks, camera frames) are stored as a structured array with int64 ns
+    `start` and `end` fields. Derived columns like `duration` are computed on
+    access instead of being stored. Other numeric tables (alignment indices)
+    keep one compact array per column.
+
+    Usage:
+    - Create with `CompactStream.from_pandas(data)`.
+    - Access fields with `stream["t"]`, `stream["value"]`, `stream["start"]`,
+      `stream["end"]`, `stream["duration"]` (int64 ns), or a table column.
+    - Call `to_pandas()` to get the original pandas object back, timestamps
+      and (float32) values are views on the compact arrays where possible.
+
+    Attributes:
+    - kind (str): `series`, `intervals` or `table`.
+    - t, values (np.ndarray): Timestamps and values of a series.
+    - intervals (np.ndarray): Structured interval array.
+    - columns (dict): Column arrays of a table.
+    """
+    INTERVAL_DTYPE = np.dtype([("start", np.int64), ("end", np.int64)])
+
+    def __init__(self, kind, meta, t=None, values=None, intervals=None, 
+                 columns=None):
+        """
+        Args:
+        - kind (str): `series`, `intervals` or `table`.
+        - meta (dict): What is needed to rebuild the pandas object (names,
+          index type, original dtypes).
+        - t, values (np.ndarray, optional): Timestamps and values of a series.
+        - intervals (np.ndarray, optional): Structured interval array.
+        - columns (dict, optional): Column arrays of a table.
+        """
+        self.kind = kind
+        self._meta = meta
+        self.t = t
+        self.values = values
+        self.intervals = intervals
+        self.columns = columns
+
+    @classmethod
+    def from_pandas(cls, data):
+        """
+        Convert a session stream to its compact representation.
+
+        Args:
+        - data (pd.Series or pd.DataFrame): A Series with a DatetimeIndex or
+          a unix timestamp (seconds) index, a DataFrame with `start`/`end`
+          datetime columns (and an optional `duration` column), or a 
+          DataFrame of numeric columns.
+
+        Returns:
+        - CompactStream: The compact stream.
+        """
+        if isinstance(data, pd.Series):
+            if isinstance(data.index, pd.DatetimeIndex):
+                t, index_unit = datetime2ns(data.index), "datetime"
+            elif pd.api.types.is_numeric_dtype(data.index):
+                # unix timestamps in seconds (ON/OFF switches)
+                t = np.round(data.index.values.astype(np.float64) *1e9).astype(np.int64)
+                index_unit = "unix_s"
+            else:
+                raise ValueError(f"Unsupported index type {type(data.index)}")
+            meta = {"name": data.name, "index_name": data.index.name,
+                    "index_unit": index_unit, "dtype": data.dtype}
+            return cls("series", meta, t=t, values=_compact_values(data.values))
+
+        meta = {"columns": list(data.columns), "index_name": data.index.name}
+        if isinstance(data.index, pd.RangeIndex):
+            meta["range"] = (data.index.start, data.index.step)
+        else:
+            meta["index"] = data.index.values.copy()
+
+        if {"start", "end"} <= set(data.columns) <= {"start", "end", "duration"}:
+            intervals = np.empty(len(data), dtype=cls.INTERVAL_DTYPE)
+            intervals["start"] = datetime2ns(data["start"])
+            intervals["end"] = datetime2ns(data["end"])
+            return cls("intervals", meta, intervals=intervals)
+        
+        if not all(pd.api.types.is_numeric_dtype(dt) for dt in data.dtypes):
+            raise ValueError(f"Unsupported columns {list(data.columns)}, expected "
+                             f"`start`, `end` (and `duration`) or numeric columns")
+        meta["dtypes"] = dict(data.dtypes)
+        meta["n_rows"] = len(data)
+        columns = {col: _compact_values(data[col].values) for col in data.columns}
+        return cls("table", meta, columns=columns)
+
+    def to_pandas(self):
+        """
+        Rebuild the pandas object the stream was created from.
+        """
+        if self.kind == "series":
+            if self._meta["index_unit"] == "datetime":
+                index = pd.DatetimeIndex(self.t.view("datetime64[ns]"), copy=False)
+            else:
+                index = pd.Index(self.t /1e9)
+            index.name = self._meta["index_name"]
+            values = self.values.astype(self._meta["dtype"], copy=False)
+            return pd.Series(values, index=index, name=self._meta["name"], copy=False)
+
+        if "range" in self._meta:
+            start, step = self._meta["range"]
+            index = pd.RangeIndex(start, start+step*len(self), step)
+        else:
+            index = pd.Index(self._meta["index"])
+        index.name = self._meta["index_name"]
+        if self.kind == "table":
+            columns = {col: arr.astype(self._meta["dtypes"][col], copy=False)
+                       for col, arr in self.columns.items()}
+        else:
+            columns = {col: self[col].view("datetime64[ns]" if col != "duration"
+                                           else "timedelta64[ns]")
+                       for col in self._meta["columns"]}
+        return pd.DataFrame(columns, index=index, columns=self._meta["columns"], 
+                            copy=False)
+
+    def __getitem__(self, field):
+        if self.kind == "series" and field in ("t", "value"):
+            return self.t if field == "t" else self.values
+        if self.kind == "intervals" and field in ("start", "end"):
+            return self.intervals[field]
+        if self.kind == "intervals" and field == "duration":
+            return self.intervals["end"] -self.intervals["start"]
+        if self.kind == "table" and field in self.columns:
+            return self.columns[field]
+        raise KeyError(f"No field `{field}` in {self.kind} stream")
+
+    def __len__(self):
+        if self.kind == "table":
+            return self._meta["n_rows"]
+        return len(self.t) if self.kind == "series" else len(self.intervals)
+
+    @property
+    def nbytes(self):
+        if self.kind == "series":
+            return self.t.nbytes + self.values.nbytes
+        index_nbytes = getattr(self._meta.get("index"), "nbytes", 0)
+        if self.kind == "table":
+            return sum(arr.nbytes for arr in self.columns.values()) + index_nbytes
+        return self.intervals.nbytes + index_nbytes
+
+    def switch_blocks(self, on_value=1):
+        """
+        Intervals between switching on and the next switch (e.g. ON/OFF
+        blocks of the reward log). A block that is not switched off ends at
+        the last switch.
+
+        Args:
+        - on_value (int): Value of the switch that starts a block.
+
+        Returns:
+        - CompactStream: Interval stream of the blocks.
+        """
+        if self.kind != "series":
+            raise ValueError("Switch blocks can only be derived from a series")
+        on = np.flatnonzero(self.values == on_value)
+        intervals = np.empty(len(on), dtype=self.INTERVAL_DTYPE)
+        intervals["start"] = self.t[on]
+        intervals["end"] = self.t[np.minimum(on+1, len(self)-1)]
+        meta = {"columns": ["start", "end", "duration"], "index_name": None,
+                "range": (0, 1)}
+        return CompactStream("intervals", meta, intervals=intervals)
+
+def _compact_values(values):
+    # smallest dtype that represents the values exactly, floats become float32
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+    if np.issubdtype(values.dtype, np.floating):
+        finite = np.isfinite(values).all()
+        if not (finite and np.array_equal(values, np.round(values))):
+            return values.astype(np.float32, copy=False)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if values.size == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype)
+    return values.astype(np.float32) if values.dtype.kind == 'f' else values
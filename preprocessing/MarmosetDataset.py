@@ -1,8 +1,16 @@
 import os
-import pickle
+import traceback
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 from .MarmosetSessionData import MarmosetSessionData
+from .data_io import read_session_catalog
+from .data_io import write_session_catalog
+from .data_io import list_dataset_partitions
+from .data_io import scan_session_tree
+from .data_io import write_dict2json
+from .data_io import read_json
+from .data_utils import filter_session_catalog
 
 from general_modules.config import *
 from general_modules.CustomLogger import CustomLogger
@@ -14,12 +22,26 @@ class MarmosetDataset:
     logger = CustomLogger(__name__, write_to_directory=LOG_TO_DIR)
 
     def __init__(self, data_path, use_precomp=True, exclude_days=[], 
-                 only_days=[]):
-        if use_precomp:
-            pass
+                 only_days=[], n_workers=1, lazy=False, compact=False, 
+                 min_length=None, start_date=None, end_date=None, 
+                 min_rewards_per_min=None):
+        self.data_path = data_path
+        catalog_filters = {"min_length": min_length, "start_date": start_date, 
+                           "end_date": end_date, 
+                           "min_rewards_per_min": min_rewards_per_min}
 
         sess_dirs = self._parse_session_dirs(data_path, exclude_days, only_days)
-        self.sessions = self._create_session_instances(data_path, sess_dirs, use_precomp)
+        # filter the sessions with known properties before loading any data
+        self.catalog = read_session_catalog(data_path)
+        sess_dirs = self._filter_session_dirs(sess_dirs, catalog_filters)
+
+        self.sessions = self._create_session_instances(data_path, sess_dirs, 
+                                                       use_precomp, n_workers, lazy,
+                                                       compact)
+        self.stage_profile, self.stage_profile_summary = self._aggregate_stage_profiles()
+        self._update_catalog()
+        if any(f is not None for f in catalog_filters.values()):
+            self.sessions = self.subset_sessions(**catalog_filters)
     
     def __iter__(self):
         self.index = 0
@@ -33,39 +55,260 @@ class MarmosetDataset:
         raise StopIteration
 
     def _parse_session_dirs(self, data_path, exclude_days, only_days):
-        day_dirs = [d for d in sorted(os.listdir(data_path)) if d != "tobiiImgs"]
-        session_dirs = {dd: sorted(os.listdir(os.path.join(data_path, dd))) 
-                        for dd in day_dirs}
-        
-        if exclude_days:
-            session_dirs = {dd: sorted(os.listdir(os.path.join(data_path, dd))) 
-                            for dd in day_dirs if dd not in exclude_days}
-        if only_days:
-            session_dirs = {dd: sorted(os.listdir(os.path.join(data_path, dd))) 
-                            for dd in day_dirs if dd in only_days}
+        # day -> {session: preproc directory names}, one scandir walk that
+        # reuses the cached listing of unchanged directories
+        session_dirs = scan_session_tree(data_path, self.logger, exclude_days, only_days)
 
         sessions_str = '\n\t'.join(['{}:\n\t\t{},'.format(dd, ',\n\t\t'.join(sd)) 
                                     for dd, sd in session_dirs.items()])
         self.logger.info((f"Parsed marmoset behavior session directories.\n"
                           f"\tFound {sessions_str.count(',')} sessions on "
-                          f"{len(day_dirs)} different days:\n\t{sessions_str}"))
+                          f"{len(session_dirs)} different days:\n\t{sessions_str}"))
         return session_dirs
         
-    def _create_session_instances(self, data_path, session_dirs, use_precomp):
-        sessions = []
+    def _create_session_instances(self, data_path, session_dirs, use_precomp,
+                                  n_workers, lazy, compact):
+        session_args = []
         for day_dir, session_dirs in session_dirs.items():
-            for session_dir in session_dirs:
+            for session_dir, preproc_dirs in session_dirs.items():
                 session_data_path = os.path.join(data_path, day_dir, session_dir)
-                
-                preproc_exists = any([os.path.isdir(os.path.join(session_data_path,el)) 
-                                      for el in os.listdir(session_data_path)])
-                rw = "read" if preproc_exists and use_precomp else "write"
+                # update: reads the preprocessed data, recomputes stale stages
+                rw = "update" if use_precomp else "write"
+                session_args.append((session_data_path, rw, lazy, compact, 
+                                     preproc_dirs))
+
+        if n_workers > 1:
+            self.logger.info(f"Processing {len(session_args)} sessions with "
+                             f"{n_workers} worker processes.")
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                # futures are collected in submission order -> deterministic
+                futures = [executor.submit(_create_session_instance, *args)
+                           for args in session_args]
+                results = [self._collect_result(fut) for fut in futures]
+        else:
+            results = [_create_session_instance(*args) for args in session_args]
+
+        self.session_summary = pd.DataFrame(
+            [(path, rw, sess is not None, err) 
+             for (path, rw, *_), (sess, err) in zip(session_args, results)],
+            columns=["session_path", "readwrite_preproc", "success", "error"])
+        
+        failed = self.session_summary[~self.session_summary.success]
+        if not failed.empty:
+            self.logger.error("\n\t".join(
+                [f"{len(failed)}/{len(session_args)} sessions failed:"] 
+                + [f"{path}: {err.strip().splitlines()[-1]}" 
+                   for path, err in zip(failed.session_path, failed.error)]))
+        return [sess for sess, _ in results if sess is not None]
+
+    def _collect_result(self, future):
+        try:
+            return future.result()
+        except Exception:
+            # the worker process itself died (e.g. BrokenProcessPool)
+            return None, traceback.format_exc()
+
+    def _aggregate_stage_profiles(self):
+        # where the preprocessing time went across the sessions processed now
+        rows = [{"session_path": os.path.relpath(sess.data_path, self.data_path),
+                 "stage": stage, **profile}
+                for sess in self.sessions if sess.preproc_report is not None
+                for stage, profile in sess.preproc_report["stages"].items()]
+        if not rows:
+            return None, None
+        
+        stage_profile = pd.DataFrame(rows)
+        summary = stage_profile.groupby("stage").agg(
+            n_sessions=("session_path", "size"),
+            total_wall_time=("wall_time", "sum"),
+            mean_wall_time=("wall_time", "mean"),
+            max_wall_time=("wall_time", "max"),
+            total_cpu_time=("cpu_time", "sum"),
+            max_peak_rss_increase_mb=("peak_rss_increase_mb", "max"),
+        ).sort_values("total_wall_time", ascending=False)
+        # stages run concurrently, this is the share of the summed stage times
+        summary["wall_time_share"] = summary.total_wall_time /summary.total_wall_time.sum()
+
+        n_sessions = stage_profile.session_path.nunique()
+        summary_str = summary.round(3).to_string().replace("\n", "\n\t")
+        self.logger.info(f"Preprocessing time per stage across {n_sessions} "
+                         f"sessions:\n\t{summary_str}")
+        return stage_profile, summary
+
+    def _filter_session_dirs(self, session_dirs, catalog_filters):
+        if self.catalog is None or all(f is None for f in catalog_filters.values()):
+            return session_dirs
+        
+        mask = filter_session_catalog(self.catalog, **catalog_filters)
+        excluded = set(self.catalog.session_path[~mask])
+        filtered_dirs = {dd: {sd: pds for sd, pds in sds.items() 
+                              if os.path.join(dd, sd) not in excluded}
+                         for dd, sds in session_dirs.items()}
+        n_excluded = sum(len(sds) for sds in session_dirs.values()) \
+                     - sum(len(sds) for sds in filtered_dirs.values())
+        self.logger.info(f"Skipping {n_excluded} sessions based on the session catalog.")
+        return filtered_dirs
+
+    def _update_catalog(self):
+        # replace the catalog rows of the (re)processed sessions
+        entries = []
+        for sess in self.sessions:
+            try:
+                entry = sess.catalog_entry
+            except Exception as e:
+                self.logger.warning(f"No catalog entry for {sess.data_path}: {e}")
+                continue
+            entry["session_path"] = os.path.relpath(sess.data_path, self.data_path)
+            entries.append(entry)
+        if not entries:
+            return
+        
+        new_catalog = pd.DataFrame(entries)
+        if self.catalog is not None:
+            old_rows = ~self.catalog.session_path.isin(new_catalog.session_path)
+            new_catalog = pd.concat([self.catalog[old_rows], new_catalog])
+        self.catalog = new_catalog.sort_values("session_path", ignore_index=True)
+        write_session_catalog(self.catalog, self.data_path)
+
+    def save(self, store_path):
+        """
+        Write the sessions to a consolidated dataset store, partitioned by day
+        and session. Only the partitions of this dataset's sessions are 
+        (re)written, the other days in the store are kept, so adding a 
+        recording day appends its partitions. Every day partition has the 
+        catalog rows of its sessions.
+
+        Args:
+        - store_path (str): Dataset store directory.
+        """
+        os.makedirs(store_path, exist_ok=True)
+        write_dict2json({"version": DATASET_STORE_VERSION, "data_path": self.data_path},
+                        store_path, DATASET_STORE_META_FNAME)
+        days = set()
+        for sess in self.sessions:
+            partition_path = os.path.join(store_path, 
+                                          os.path.relpath(sess.data_path, self.data_path))
+            os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+            sess.write_partition(partition_path)
+            days.add(os.path.basename(os.path.dirname(partition_path)))
+        
+        if self.catalog is not None:
+            day_of_row = self.catalog.session_path.map(
+                lambda path: os.path.normpath(path).split(os.sep)[0])
+            for day in days:
+                day_path = os.path.join(store_path, day)
+                day_catalog = self.catalog[day_of_row == day]
+                old_catalog = read_session_catalog(day_path)
+                if old_catalog is not None:
+                    old_rows = ~old_catalog.session_path.isin(day_catalog.session_path)
+                    day_catalog = pd.concat([old_catalog[old_rows], day_catalog])
+                write_session_catalog(day_catalog.sort_values("session_path", ignore_index=True),
+                                      day_path)
+        self.logger.info(f"Saved {len(self.sessions)} sessions of {len(days)} days "
+                         f"to the dataset store {store_path}.")
+
+    @classmethod
+    def load(cls, store_path, exclude_days=[], only_days=[], lazy=True, 
+             compact=False, min_length=None, start_date=None, end_date=None, 
+             min_rewards_per_min=None):
+        """
+        Load a dataset from a store written by `save`. Only the partitions of
+        the selected days are read, the catalog filters are applied to the 
+        day catalogs before any session is read. Sessions without catalog 
+        rows are read and filtered on their properties.
+
+        Args:
+        - store_path (str): Dataset store directory.
+        - exclude_days, only_days (list): Day directory names (YYYY-MM-DD).
+        - lazy (bool): Read the session streams on first access.
+        - compact (bool): Keep the streams as `CompactStream`s.
+        - min_length, start_date, end_date, min_rewards_per_min: Catalog 
+          filters, see `subset_sessions`.
+
+        Returns:
+        - MarmosetDataset: The dataset, `data_path` is the raw data path the
+          store was written from.
+        """
+        store_meta = read_json(store_path, DATASET_STORE_META_FNAME)
+        if store_meta["version"] != DATASET_STORE_VERSION:
+            raise ValueError(f"Dataset store {store_path} has version "
+                             f"{store_meta['version']}, expected {DATASET_STORE_VERSION}.")
+        partitions = list_dataset_partitions(store_path, exclude_days, only_days,
+                                             start_date, end_date)
+        
+        dataset = cls.__new__(cls)
+        dataset.data_path = store_meta["data_path"]
+        catalogs = [read_session_catalog(os.path.join(store_path, day)) for day in partitions]
+        catalogs = [catalog for catalog in catalogs if catalog is not None]
+        dataset.catalog = (pd.concat(catalogs, ignore_index=True) if catalogs else None)
+
+        # relative session path (catalog key) -> partition path
+        session_paths = {os.path.relpath(path, store_path): path 
+                         for paths in partitions.values() for path in paths}
+        catalog_filters = {"min_length": min_length, "start_date": start_date, 
+                           "end_date": end_date, 
+                           "min_rewards_per_min": min_rewards_per_min}
+        filtered = any(f is not None for f in catalog_filters.values())
+        uncataloged = list(session_paths)
+        if dataset.catalog is not None:
+            catalog_paths = dataset.catalog.session_path.map(os.path.normpath)
+            uncataloged = [rel_path for rel_path in session_paths 
+                           if rel_path not in set(catalog_paths)]
+            mask = catalog_paths.isin(list(session_paths))
+            if filtered:
+                mask &= filter_session_catalog(dataset.catalog, **catalog_filters)
+                selected = set(catalog_paths[mask]).union(uncataloged)
+                session_paths = {rel_path: path for rel_path, path in session_paths.items()
+                                 if rel_path in selected}
+            dataset.catalog = dataset.catalog[mask].reset_index(drop=True)
+
+        sessions = {rel_path: MarmosetSessionData.read_partition(path, lazy) 
+                    for rel_path, path in session_paths.items()}
+        if filtered and uncataloged:
+            # no catalog rows, filter on the session properties instead
+            cls.logger.warning(f"{len(uncataloged)} sessions in {store_path} have no "
+                               f"catalog rows, they are read to apply the filters.")
+            entries = pd.DataFrame([sessions[rel_path].catalog_entry 
+                                    for rel_path in uncataloged])
+            mask = filter_session_catalog(entries, **catalog_filters)
+            for rel_path, keep in zip(uncataloged, mask):
+                if not keep:
+                    sessions.pop(rel_path)
+        dataset.sessions = list(sessions.values())
+        if compact:
+            [sess.to_compact() for sess in dataset.sessions]
+        dataset.session_summary = pd.DataFrame(
+            [(sess.data_path, "store", True, None) for sess in dataset.sessions],
+            columns=["session_path", "readwrite_preproc", "success", "error"])
+        dataset.stage_profile, dataset.stage_profile_summary = None, None
+        cls.logger.info(f"Loaded {len(dataset.sessions)} sessions of "
+                        f"{len(partitions)} days from the dataset store {store_path}.")
+        return dataset
 
-                sessions.append(MarmosetSessionData(session_data_path, rw))
-        return sessions
+    def subset_sessions(self, min_length=None, start_date=None, end_date=None, 
+                        min_rewards_per_min=None):
+        if self.catalog is None:
+            return [s for s in self.sessions 
+                    if min_length is None or s.session_length > min_length]
+        mask = filter_session_catalog(self.catalog, min_length, start_date, 
+                                      end_date, min_rewards_per_min)
+        selected = set(self.catalog.session_path[mask])
+        return [s for s in self.sessions 
+                if os.path.relpath(s.data_path, self.data_path) in selected]
 
-    def subset_sessions(self, min_length):
-        return [s for s in self.sessions if s.session_length > min_length]
+def _create_session_instance(session_data_path, readwrite_preproc, lazy, compact,
+                             preproc_dirs=None):
+    # module level so that it can be pickled for the process pool
+    try:
+        sess = MarmosetSessionData(session_data_path, readwrite_preproc, lazy, 
+                                   preproc_dirs)
+        if compact:
+            # compact arrays also make the transfer from the worker cheaper
+            sess.to_compact()
+        return sess, None
+    except (Exception, SystemExit):
+        MarmosetDataset.logger.error(f"Failed to process session {session_data_path}")
+        return None, traceback.format_exc()
 
 def main():
     # tmp = MarmosetDataset(data_path="/mnt/NTnas/MarmosetBehavior/Data/", 
@@ -73,10 +316,8 @@ def main():
     #                 #               "2023-09-05", ], 
     #                 # only_days=["2023-08-24"], 
     #                 use_precomp=False)
-    # with open('dataset_tmp.pkl', 'wb') as file:
-    #     pickle.dump(tmp, file)
-    with open('dataset_tmp.pkl', 'rb') as file:
-        tmp = pickle.load(file)
+    # tmp.save('dataset_store')
+    tmp = MarmosetDataset.load('dataset_store')
     
     dates = set([d.start_date for d in tmp.sessions])
     
@@ -1,161 +1,551 @@
 import os
+import time
+import shutil
 import pandas as pd
 import numpy as np
+from functools import partial
+from functools import cached_property
 
-from .data_utils import check_timeseries_integrity
+from .data_utils import get_interval_overlaps
+from .data_utils import datetime2ns
+from .data_utils import detect_threshold_edges
+from .data_utils import pair_edges
+from .data_utils import asof_indices
+from .data_utils import binary_intervals
+from .data_utils import intervals2frame
+from .data_utils import frame_intervals
 from .video_utils import write_facecam_vid
+from .StageScheduler import StageScheduler
+from .CompactStream import CompactStream
+from .TimestampIntegrity import TimestampIntegrity
+from .StreamingTimeFilter import StreamingTimeFilter
+from .SessionFollower import SessionFollower
 
 from .data_io import read_metadata_file
 from .data_io import read_sensor_file
 from .data_io import read_reward_file
-from .data_io import read_video_ts_files
+from .data_io import read_video_ts_file
 from .data_io import write_dict2json
-from .data_io import write_pkl
-from .data_io import load_prepoc_data
+from .data_io import read_json
+from .data_io import stage_file
+from .data_io import write_txt_file
+from .data_io import write_preproc_data
+from .data_io import read_preproc_data
+from .data_io import preproc_output_exists
+from .data_io import find_preproc_dir
+from .data_io import read_preproc_manifest
+from .data_io import get_stale_preproc_stages
+from .data_io import create_preproc_manifest
 
 from general_modules.config import *
 from general_modules.CustomLogger import CustomLogger
 
+class _PreprocStream:
+    # attribute that is read from the preproc directory on first access
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if "_follower" in instance.__dict__:
+            # follow mode, the stream so far
+            return instance._follower.stream(self.name)
+        if self.name not in instance.__dict__:
+            compact_streams = instance.__dict__.get("compact_streams", {})
+            if self.name in compact_streams:
+                # rebuilt on every access, only the compact arrays are kept
+                compact = compact_streams[self.name]
+                return compact.to_pandas() if compact is not None else None
+            if instance._preproc_path is None:
+                raise AttributeError(self.name)
+            instance.__dict__[self.name] = read_preproc_data(instance._preproc_path, 
+                                                             self.fname, 
+                                                             instance.logger)
+        return instance.__dict__[self.name]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
 class MarmosetSessionData():
     logger = CustomLogger(__name__, write_to_directory=LOG_TO_DIR)
 
-    def __init__(self, data_path, readwrite_preproc="write"):
+    expframe_ts_data = _PreprocStream(EXPFRAME_TS_OUTFNAME)
+    lick_data = _PreprocStream(LICK_OUTFNAME)
+    dist_left_data = _PreprocStream(DIST_LEFT_OUTFNAME)
+    reward_data = _PreprocStream(REWARD_OUTFNAME)
+    onoff_swtiches = _PreprocStream(ONOFF_OUTFNAME)
+    frontcam_ts = _PreprocStream(FRONTCAM_TS_OUTFNAME)
+    scenecam_ts = _PreprocStream(SCENECAM_TS_OUTFNAME)
+    facecam_ts = _PreprocStream(FACECAM_TS_OUTFNAME)
+    frontcam_alignment = _PreprocStream(FRONTCAM_ALIGNMENT_OUTFNAME)
+    scenecam_alignment = _PreprocStream(SCENECAM_ALIGNMENT_OUTFNAME)
+    facecam_alignment = _PreprocStream(FACECAM_ALIGNMENT_OUTFNAME)
+
+    def __init__(self, data_path, readwrite_preproc="write", lazy=False, 
+                 preproc_dirs=None):
         # load the metadata
         self.metad = read_metadata_file(data_path)
+        self.data_path = data_path
+        self._preproc_path = None
+        self.preproc_report = None
+        self.compact_streams = {}
         
         # read the session name from the datapath to setup the logger headers
         _name = "{session_start_date}_{session_start_time}".format(**self.metad)
         self.logger.extend_fmt(f'|{_name}')
 
-        if readwrite_preproc == "write":
-            # load the sensor data and preprocess it
-            sensor_data = read_sensor_file(data_path, self.logger)
-            photores_d, lick_d, dist_left_d = self._extract_sensors(sensor_data)
-            self.expframe_ts_data = self._preproc_photores_data(photores_d)
-            self.lick_data = self._preproc_lick_data(lick_d)
-            self.dist_left_data = self._preproc_dist_data(dist_left_d)
-
-            # load the reward data
-            self.reward_data, self.onoff_swtiches = read_reward_file(data_path, self.logger)
-            
-            # load the video frame timestamps data and preprocess, check videos
-            frontcam_ts, scenecam_ts, facecam_ts = read_video_ts_files(data_path, 
-                                                                       self.logger)
-            ret = self._preproc_expframe_ts_data(frontcam_ts, scenecam_ts, facecam_ts)
-            self.frontcam_ts, self.scenecam_ts, self.facecam_ts = ret
-            
-            # prepare saving the data, create an annotated face camera video
-            dest_path = os.path.join(data_path, "preproc_"+self.session_name)
-            self._save_prepoc_data(dest_path)    
+        if readwrite_preproc in ("write", "update"):
+            stages = list(PREPROC_STAGES)
+            preproc_path = None
+            if readwrite_preproc == "update":
+                # only recompute stages whose raw inputs/parameters changed
+                preproc_path = find_preproc_dir(data_path, preproc_dirs)
+                stages = get_stale_preproc_stages(data_path, preproc_path, 
+                                                  self.metad, self.logger)
+                # unchanged outputs are read on access
+                if len(stages) < len(PREPROC_STAGES):
+                    self._preproc_path = preproc_path
+
+            # run the stages, create an annotated face camera video, save
+            if stages:
+                with self.logger.capture() as preproc_log, \
+                     self.logger.profile("preprocessing") as total_profile:
+                    self._run_preproc_stages(data_path, preproc_path, stages)
+                    dest_path = self._prepare_dest_path(data_path, preproc_path)
+                    with self.logger.profile("save") as save_profile:
+                        self._save_prepoc_data(dest_path, data_path, stages)
+                self._save_preproc_report(dest_path, stages, total_profile, 
+                                          save_profile, preproc_log.getvalue())
+            if not lazy:
+                self._load_prepoc_data()
         
+        elif readwrite_preproc == 'follow':
+            # running session, the streams are updated by `update`
+            self._follower = SessionFollower(data_path, self.metad, self.logger)
+            self.update()
+
         elif readwrite_preproc == 'read':
-            (self.expframe_ts_data, self.lick_data, self.dist_left_data, 
-            self.reward_data, self.onoff_swtiches, self.frontcam_ts, self.scenecam_ts, 
-            self.facecam_ts) = load_prepoc_data(data_path, self.logger)
-            print(self.reward_data)
+            self._preproc_path = find_preproc_dir(data_path, preproc_dirs)
+            if self._preproc_path is None:
+                self.logger.error(f"No preprocessed data found in {data_path}.")
+            elif not lazy:
+                self._load_prepoc_data()
 
         else:
             self.logger.critical((f"Invalid input for `readwrite_preproc`: "
-                                 f"{readwrite_preproc}. Valid inputs are `read`"
-                                 f" and `write`"))
+                                 f"{readwrite_preproc}. Valid inputs are `read`,"
+                                 f" `write`, `update` and `follow`"))
             exit(1)
         self.logger.spacer()
 
+    def _run_preproc_stages(self, data_path, preproc_path, stages):
+        # independent loaders run concurrently, dependent steps wait
+        scheduler = StageScheduler(SESSION_STAGE_N_WORKERS, self.logger)
+        if "sensor" in stages:
+            scheduler.add_stage("sensor_read", partial(self._read_sensor_data, data_path))
+            scheduler.add_stage("photores", self._process_photores_data, ("sensor_read",))
+            scheduler.add_stage("lick", self._process_lick_data, ("sensor_read",))
+            scheduler.add_stage("dist", self._process_dist_data, ("sensor_read",))
+        if "reward" in stages:
+            scheduler.add_stage("reward", partial(self._process_reward_data, data_path))
+        if "video_ts" in stages:
+            for cam in ("frontcam", "scenecam", "facecam"):
+                scheduler.add_stage(f"{cam}_ts", partial(self._process_cam_ts_data, 
+                                                         data_path, cam))
+        if "alignment" in stages:
+            scheduler.add_stage("alignment", self._process_alignment,
+                                ("photores", "lick", "dist", "reward", "frontcam_ts",
+                                 "scenecam_ts", "facecam_ts"))
+        if WRITE_FACECAM_VID:
+            scheduler.add_stage("facecam_vid", partial(self._write_facecam_vid, data_path,
+                                                       preproc_path),
+                                ("photores", "lick", "reward", "facecam_ts", "alignment"))
+        self.stage_results = scheduler.run()
+        self._sensor_data = None
+        scheduler.raise_for_failed()
+
+    def _read_sensor_data(self, data_path):
+        # load the sensor data, the sensors are processed in separate stages,
+        # the distance sensor is filtered while reading (needs sorted timestamps)
+        self._dist_filter = None
+        if SENSOR_TS_REPAIR is not None:
+            self._dist_filter = StreamingTimeFilter.for_distance_sensor(self.metad)
+        sensor_data = read_sensor_file(data_path, self.logger, chunk_filters=(
+            {DISTANCELEFT_SENSOR_ID: self._dist_filter} if self._dist_filter else None))
+        self._sensor_data = dict(zip((PHTOTRES_SENSOR_ID, LICK_SENSOR_ID,
+                                      DISTANCELEFT_SENSOR_ID),
+                                     self._extract_sensors(sensor_data)))
+
+    # the raw sensor streams are released as soon as their stage is done,
+    # not when all stages are
+    def _process_photores_data(self):
+        photores_d = self._sensor_data.pop(PHTOTRES_SENSOR_ID)
+        self.expframe_ts_data = self._preproc_photores_data(photores_d)
+
+    def _process_lick_data(self):
+        self.lick_data = self._preproc_lick_data(self._sensor_data.pop(LICK_SENSOR_ID))
+
+    def _process_dist_data(self):
+        dist_left_d = self._sensor_data.pop(DISTANCELEFT_SENSOR_ID)
+        self.dist_left_data = self._preproc_dist_data(dist_left_d, self._dist_filter)
+
+    def _process_reward_data(self, data_path):
+        # load the reward data
+        self.reward_data, self.onoff_swtiches = read_reward_file(data_path, self.logger)
+
+    def _process_cam_ts_data(self, data_path, cam):
+        # load the video frame timestamps data and preprocess, check videos
+        ts_fname, vid_fname = {"frontcam": (FRONT_CAM_TS_FNAME, FRONT_CAM_FNAME),
+                               "scenecam": (SCENE_CAM_TS_FNAME, SCENE_CAM_FNAME),
+                               "facecam": (FACE_CAM_TS_FNAME, FACE_CAM_FNAME)}[cam]
+        self.logger.info(f"Loading and processing {cam} video, vid-timestamp data")
+        frame_ts = read_video_ts_file(data_path, ts_fname, vid_fname, self.logger)
+        setattr(self, f"{cam}_ts", self._preproc_cam_ts_data(frame_ts))
+
+    def _process_alignment(self):
+        # index every camera frame into the other streams once
+        self.logger.info("Aligning camera frames with sensor, reward and lick data")
+        for cam in ("frontcam", "scenecam", "facecam"):
+            setattr(self, f"{cam}_alignment", self._align_cam_frames(cam))
+
+    def _write_facecam_vid(self, data_path, preproc_path):
+        dest_path = self._prepare_dest_path(data_path, preproc_path)
+        alignment = self.facecam_alignment
+        # decoded sequentially, a local copy is much faster than the NAS
+        with stage_file(os.path.join(data_path, FACE_CAM_FNAME), self.logger) as vid_fname:
+            write_facecam_vid(vid_fname=vid_fname,
+                              frame_ts=self.facecam_ts,
+                              lick_frames=self._get_lickframes(self.facecam_ts, alignment),
+                              reward_frames=self._get_rewardframes(self.facecam_ts, 
+                                                                   alignment),
+                              dest_path=dest_path,
+                              output_fname=FACECAM_VID_OUTFNAME,
+                              logger=self.logger)
+
+    def _prepare_dest_path(self, data_path, preproc_path):
+        dest_path = os.path.join(data_path, PREPROC_DIR_PREFIX+self.session_name)
+        if (preproc_path is not None and preproc_path != dest_path 
+            and os.path.isdir(preproc_path)):
+            # session name changed, keep the unchanged outputs
+            os.rename(preproc_path, dest_path)
+            if self._preproc_path == preproc_path:
+                self._preproc_path = dest_path
+        os.makedirs(dest_path, exist_ok=True)
+        return dest_path
+
+    def _load_prepoc_data(self):
+        # access all streams, not yet loaded ones are read from disk
+        if self._preproc_path is not None:
+            self.logger.info("Loading preprocessed data.")
+        [getattr(self, attr) for attr in self._preproc_streams()]
+
+    @classmethod
+    def _preproc_streams(cls):
+        return {attr: stream.fname for attr, stream in vars(cls).items() 
+                if isinstance(stream, _PreprocStream)}
+
+    def release(self, *attrs):
+        """
+        Drop loaded streams from memory, they are read again on next access.
+
+        Args:
+        - attrs (str): Stream attributes to release, all if none are passed.
+        """
+        if self._preproc_path is None:
+            self.logger.warning("No preprocessed data saved, can't release streams.")
+            return
+        for attr in (attrs or self._preproc_streams()):
+            self.__dict__.pop(attr, None)
+            self.compact_streams.pop(attr, None)
+
+    def to_compact(self, *attrs):
+        """
+        Keep streams as `CompactStream`s (int64 ns timestamps, compact value
+        dtypes, structured interval arrays) instead of pandas objects. The
+        compact streams are in `compact_streams`, accessing a compacted stream
+        attribute returns a pandas object rebuilt from the compact arrays.
+
+        Args:
+        - attrs (str): Stream attributes to compact, all if none are passed.
+        """
+        for attr in (attrs or self._preproc_streams()):
+            if attr in self.compact_streams:
+                continue
+            data = getattr(self, attr)
+            self.compact_streams[attr] = (CompactStream.from_pandas(data) 
+                                          if data is not None else None)
+            self.__dict__.pop(attr, None)
+
+    def to_pandas(self, *attrs):
+        """
+        Undo `to_compact`, keep the streams as pandas objects again.
+
+        Args:
+        - attrs (str): Stream attributes to convert, all if none are passed.
+        """
+        for attr in (attrs or list(self.compact_streams)):
+            if attr in self.compact_streams:
+                setattr(self, attr, getattr(self, attr))
+                del self.compact_streams[attr]
+
+    def update(self):
+        """
+        Follow mode (`readwrite_preproc="follow"`): process the lines appended
+        to the raw data files since the last update. Stream attributes return
+        the session so far.
+
+        Returns:
+        - dict: Session metrics, see `SessionFollower.metrics`.
+        """
+        if "_follower" not in self.__dict__:
+            self.logger.warning("Session is not followed, nothing to update.")
+            return
+        metrics = self._follower.update()
+        # bounds change while the session runs
+        for attr in ("_session_bounds", "session_start", "session_stop"):
+            self.__dict__.pop(attr, None)
+        return metrics
+
     def _extract_sensors(self, sensor_data):
-        def process_single_sensor(sensor_id):
-            sensor_dat = sensor_data[sensor_data.id == sensor_id]
-            sensor_dat = sensor_dat.set_index('logging_timestamp')
-            sensor_dat = sensor_dat.drop("id", axis=1)
-            sensor_dat = sensor_dat.squeeze().rename(sensor_id)#.sort_index()
-            return sensor_dat
-        return [process_single_sensor(s_id) for s_id 
+        # sensor data is already split by sensor id when reading
+        if sensor_data is None:
+            return None, None, None
+        return [sensor_data.get(s_id) for s_id 
                 in (PHTOTRES_SENSOR_ID,LICK_SENSOR_ID,DISTANCELEFT_SENSOR_ID)]
         
     def _preproc_photores_data(self, photores_data):
         if photores_data is None:
             return
         self.logger.info("Processing photoresistor data")
-        
-        # to be implmented: calculate frame render times
-        return photores_data
+
+        # frame render times: screen patch high intervals of the photoresistor
+        tstamps = datetime2ns(photores_data.index)
+        values = photores_data.values
+        if not photores_data.index.is_monotonic_increasing:
+            self.logger.warning("Photoresistor timestamps are not sorted.")
+            order = np.argsort(tstamps, kind='stable')
+            tstamps, values = tstamps[order], values[order]
+
+        rising, falling, carry = [], [], None
+        for start in range(0, max(len(tstamps), 1), PHOTORES_CHUNKSIZE):
+            stop = start+PHOTORES_CHUNKSIZE
+            chunk_rising, chunk_falling, carry = detect_threshold_edges(
+                tstamps[start:stop], values[start:stop], PHOTORES_BLOCK_MS*10**6,
+                PHOTORES_HYSTERESIS, PHOTORES_MIN_AMPLITUDE, carry, 
+                last_chunk=stop >= len(tstamps))
+            rising.append(chunk_rising)
+            falling.append(chunk_falling)
+        starts, ends = pair_edges(np.concatenate(rising), np.concatenate(falling),
+                                  PHOTORES_DEBOUNCE_MS*10**6)
+
+        frame_data = intervals2frame(starts, ends)
+        self.logger.info(f"Detected {len(frame_data)} frame renders")
+        if frame_data.empty:
+            self.logger.warning("No frame renders detected in the photoresistor data.")
+        return frame_data
 
     def _preproc_lick_data(self, lick_data):
         if lick_data is None:
             return
         self.logger.info("Processing lick sensor data")
 
-        # ensure that sessions start and end with no lick
-        lick_data.iloc[-1] = 0
-        lick_data.iloc[0] = 0
-        lick_onoff = lick_data.diff().fillna(0).astype(int)
+        # sessions start and end with no lick
+        values = lick_data.values.copy()
+        values[-1] = 0
+        starts, ends, _ = binary_intervals(datetime2ns(lick_data.index), values)
+        return intervals2frame(starts, ends)
 
-        lick_d = {}
-        lick_d['start'] = lick_data.iloc[np.where(lick_onoff==1)[0]].index
-        lick_d['end'] = lick_data.iloc[np.where(lick_onoff==-1)[0] -1].index
-        lick_data = pd.DataFrame(lick_d)
-        lick_data['duration'] = lick_d['end']-lick_d['start']
-        return lick_data
-
-    def _preproc_dist_data(self, dist_left_data):
+    def _preproc_dist_data(self, dist_left_data, dist_filter=None):
+        # dist_filter: the StreamingTimeFilter the data was filtered with while
+        # reading, None for raw data
         if dist_left_data is None:
             return
         self.logger.info("Processing distance sensor data")
 
-        check_timeseries_integrity(dist_left_data, self.logger)
-        windowsize = self.metad["dist_sensor_mean_windowsize"]
-        dist_left_data = dist_left_data.rolling(windowsize).mean()
-        return dist_left_data
+        integrity = TimestampIntegrity()
+        integrity.update(datetime2ns(dist_left_data.index))
+        integrity.log(self.logger, dist_left_data.name)
+        if dist_filter is not None:
+            self.logger.info(f"Filtered distance sensor: {dist_filter.how} over "
+                             f"{dist_filter.window}")
+            return dist_left_data
 
-    def _preproc_expframe_ts_data(self, frontcam_ts, scenecam_ts, facecam_ts):
-        ts_data = []
-        for ts in (frontcam_ts, scenecam_ts, facecam_ts):
-            if ts is None:
-                ts_data.append(None)
-                continue
-            
-            frame_data = {"start":ts}
-            frame_ts_end = np.roll(frame_data["start"].values, -1)
-            frame_deltat = pd.Timedelta(seconds=1/self.metad["cameraFPS"])
-            frame_ts_end[-1] = frame_ts_end[-2] + frame_deltat
-            frame_data["end"] = frame_ts_end
-            
-            frame_data = pd.DataFrame(frame_data)
-            frame_data['duration'] = frame_data['end']-frame_data['start']
-            ts_data.append(frame_data)
-        return ts_data
+        # time windows need sorted timestamps, filter in time order
+        order = None
+        if not dist_left_data.index.is_monotonic_increasing:
+            self.logger.warning("Distance sensor timestamps are not sorted.")
+            order = np.argsort(dist_left_data.index.values, kind='stable')
+        sorted_data = dist_left_data if order is None else dist_left_data.iloc[order]
+        tstamps = datetime2ns(sorted_data.index)
+
+        # chunk by chunk like while reading, only one chunk is held in float64
+        dist_filter = StreamingTimeFilter.for_distance_sensor(self.metad)
+        filtered = np.empty(len(sorted_data), dtype=np.float32)
+        n_filtered = 0
+        for start in range(0, len(sorted_data), DIST_SENSOR_FILTER_CHUNKSIZE):
+            stop = start +DIST_SENSOR_FILTER_CHUNKSIZE
+            _, chunk = dist_filter.update(tstamps[start:stop], 
+                                          sorted_data.values[start:stop])
+            filtered[n_filtered:n_filtered+len(chunk)] = chunk
+            n_filtered += len(chunk)
+        filtered[n_filtered:] = dist_filter.flush()[1]
+        self.logger.info(f"Filtered distance sensor: {dist_filter.how} over "
+                         f"{dist_filter.window}")
+        if order is not None:
+            filtered[order] = filtered.copy()
+        return pd.Series(filtered, index=dist_left_data.index, name=dist_left_data.name)
+
+    def _preproc_cam_ts_data(self, frame_ts):
+        if frame_ts is None:
+            return
+        
+        return frame_intervals(frame_ts, self.metad["cameraFPS"])
     
-    def _get_lickframes(self, which_cam_ts):
-        if which_cam_ts is not None and self.lick_data is not None:
-            def check_lick(frame_d):
-                within_startlick = ((frame_d.start <self.lick_data.start) &
-                                (frame_d.end >self.lick_data.start))
-                within_endlick = ((frame_d.start <self.lick_data.end) &
-                                (frame_d.end >self.lick_data.end))
-                within_longlick = ((frame_d.start >self.lick_data.start) &
-                                (frame_d.end <self.lick_data.end))
-                return any(within_startlick | within_endlick | within_longlick)
-            return which_cam_ts.apply(check_lick, axis=1)
+    def _align_cam_frames(self, cam):
+        frame_ts = getattr(self, f"{cam}_ts")
+        if frame_ts is None:
+            return
+        
+        # -1 where there is no sample/event (yet)
+        alignment = {}
+        if self.dist_left_data is not None:
+            alignment["dist_left"] = asof_indices(frame_ts.start, 
+                                                  self.dist_left_data.index, "nearest")
+        if self.expframe_ts_data is not None:
+            # render shown when the frame started
+            alignment["expframe"] = asof_indices(frame_ts.start, 
+                                                 self.expframe_ts_data.start)
+        # last lick/reward before the frame ended
+        if self.lick_data is not None:
+            alignment["lick"] = asof_indices(frame_ts.end, self.lick_data.start, 
+                                             strict=True)
+        if self.reward_data is not None:
+            alignment["reward"] = asof_indices(frame_ts.end, self.reward_data.index, 
+                                               strict=True)
+        if cam == "facecam":
+            for other_cam in ("frontcam", "scenecam"):
+                other_ts = getattr(self, f"{other_cam}_ts")
+                if other_ts is not None:
+                    alignment[other_cam] = asof_indices(frame_ts.start, other_ts.start,
+                                                        "nearest")
+        return pd.DataFrame(alignment, index=frame_ts.index)
+
+    def _get_lickframes(self, which_cam_ts, alignment=None):
+        if which_cam_ts is None or self.lick_data is None:
+            return
+        if self.lick_data.empty:
+            lick_frames = np.zeros(len(which_cam_ts), dtype=bool)
+        elif alignment is not None and "lick" in alignment:
+            # the last lick starting before the frame end is the only candidate
+            lick_idx = alignment.lick.values
+            lick_ends = datetime2ns(self.lick_data.end)[np.maximum(lick_idx, 0)]
+            lick_frames = (lick_idx >= 0) & (lick_ends > datetime2ns(which_cam_ts.start))
+        else:
+            lick_frames = get_interval_overlaps(which_cam_ts.start, which_cam_ts.end,
+                                                self.lick_data.start, 
+                                                self.lick_data.end)
+        return pd.Series(lick_frames, index=which_cam_ts.index)
     
-    def _get_rewardframes(self, which_cam_ts):
-        if which_cam_ts is not None and self.lick_data is not None:
-            check_rew = lambda fr_d: any((self.reward_data.index>fr_d.start) & 
-                                         (self.reward_data.index<fr_d.end))
-            return which_cam_ts.apply(check_rew, axis=1)
+    def _get_rewardframes(self, which_cam_ts, alignment=None):
+        if which_cam_ts is None or self.reward_data is None:
+            return
+        if self.reward_data.empty:
+            reward_frames = np.zeros(len(which_cam_ts), dtype=bool)
+        elif alignment is not None and "reward" in alignment:
+            reward_idx = alignment.reward.values
+            reward_t = datetime2ns(self.reward_data.index)[np.maximum(reward_idx, 0)]
+            reward_frames = (reward_idx >= 0) & (reward_t > datetime2ns(which_cam_ts.start))
+        else:
+            reward_frames = get_interval_overlaps(which_cam_ts.start, which_cam_ts.end,
+                                                  self.reward_data.index)
+        return pd.Series(reward_frames, index=which_cam_ts.index)
 
-    def _save_prepoc_data(self, dest_path):
+    def _save_prepoc_data(self, dest_path, data_path, stages):
         os.makedirs(dest_path, exist_ok=True)
-        fname_mapping = {EXPFRAME_TS_OUTFNAME: self.expframe_ts_data,
-                         LICK_OUTFNAME: self.lick_data,
-                         DIST_LEFT_OUTFNAME: self.dist_left_data,
-                         REWARD_OUTFNAME: self.reward_data,
-                         ONOFF_OUTFNAME: self.onoff_swtiches,
-                         FRONTCAM_TS_OUTFNAME: self.frontcam_ts,
-                         SCENECAM_TS_OUTFNAME: self.scenecam_ts,
-                         FACECAM_TS_OUTFNAME: self.facecam_ts}
-        [write_pkl(dest_path, fname, data, self.logger) 
-         for fname, data in fname_mapping.items()]
+        # remove the manifest first, an interrupted write then counts as stale,
+        # the fingerprints of unchanged raw files are kept
+        old_manifest = read_preproc_manifest(dest_path)
+        manifest_fname = os.path.join(dest_path, PREPROC_MANIFEST_FNAME)
+        if os.path.exists(manifest_fname):
+            os.remove(manifest_fname)
+
+        stage_fnames = [fn for stage in stages for fn in PREPROC_STAGES[stage]["outputs"]]
+        outputs = {}
+        for attr, fname in self._preproc_streams().items():
+            if fname in stage_fnames:
+                data = getattr(self, attr)
+                write_preproc_data(dest_path, fname, data, self.logger)
+                outputs[fname] = data is not None
+            else:
+                outputs[fname] = preproc_output_exists(dest_path, fname)
         write_dict2json(self.metad, dest_path, "metadata.json")
 
+        manifest = create_preproc_manifest(data_path, self.metad, outputs, old_manifest)
+        write_dict2json(manifest, dest_path, PREPROC_MANIFEST_FNAME)
+        self._preproc_path = dest_path
+
+    def write_partition(self, partition_path):
+        """
+        Write all streams and the metadata to a dataset store partition (see
+        `MarmosetDataset.save`). An existing partition is replaced once the 
+        new one is complete.
+
+        Args:
+        - partition_path (str): Partition directory.
+        """
+        tmp_path = partition_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for attr, fname in self._preproc_streams().items():
+            write_preproc_data(tmp_path, fname, getattr(self, attr), self.logger)
+        write_dict2json(self.metad, tmp_path, "metadata.json")
+        write_dict2json({"data_path": self.data_path, "created": time.time(),
+                         "preproc_version": PREPROC_VERSION}, 
+                        tmp_path, DATASET_STORE_SESSION_FNAME)
+        shutil.rmtree(partition_path, ignore_errors=True)
+        os.replace(tmp_path, partition_path)
+
+    @classmethod
+    def read_partition(cls, partition_path, lazy=True):
+        """
+        Session of a dataset store partition, the raw data isn't needed.
+
+        Args:
+        - partition_path (str): Partition directory.
+        - lazy (bool): Read the streams on first access.
+
+        Returns:
+        - MarmosetSessionData: The session.
+        """
+        sess = cls.__new__(cls)
+        sess.metad = read_json(partition_path, "metadata.json")
+        sess.data_path = read_json(partition_path, DATASET_STORE_SESSION_FNAME)["data_path"]
+        sess._preproc_path = partition_path
+        sess.preproc_report = None
+        sess.compact_streams = {}
+        if not lazy:
+            sess._load_prepoc_data()
+        return sess
+
+    def _save_preproc_report(self, dest_path, stages, total_profile, save_profile,
+                             preproc_log):
+        # machine readable timing/memory per stage and the debug level log
+        stage_profiles = {name: {"status": res["status"], **(res["profile"] or {})}
+                          for name, res in self.stage_results.items()}
+        stage_profiles["save"] = {"status": "done", **save_profile}
+        self.preproc_report = {"session_name": self.session_name,
+                               "created": time.time(),
+                               "preproc_version": PREPROC_VERSION,
+                               "recomputed_stages": stages,
+                               "total": total_profile,
+                               "stages": stage_profiles}
+        write_dict2json(self.preproc_report, dest_path, PREPROC_REPORT_FNAME)
+        write_txt_file(preproc_log, dest_path, PREPROC_LOG_FNAME)
+
     def __str__(self):
         msg = f"{self.session_length}"
         return msg
@@ -167,9 +557,19 @@ class MarmosetSessionData():
         duration_min_str = int((self.session_length.total_seconds() %3600)//60)
         return f"{start_str}_{duration_h_str}h-{duration_min_str}min"
 
-    @property
+    @cached_property
+    def _session_bounds(self):
+        # first and last frame render, the distance sensor without renders
+        if isinstance(self.expframe_ts_data, pd.Series):
+            # raw photoresistor samples, written before PREPROC_VERSION 3
+            return self.expframe_ts_data.index[0], self.expframe_ts_data.index[-1]
+        if self.expframe_ts_data is not None and not self.expframe_ts_data.empty:
+            return self.expframe_ts_data.start.iloc[0], self.expframe_ts_data.end.iloc[-1]
+        return self.dist_left_data.index[0], self.dist_left_data.index[-1]
+
+    @cached_property
     def session_start(self):
-        return self.expframe_ts_data.index[0] + pd.Timedelta(seconds=7200)
+        return self._session_bounds[0] + pd.Timedelta(seconds=7200)
     
     @property
     def session_start_date(self):
@@ -179,9 +579,9 @@ class MarmosetSessionData():
     def session_start_time(self):
         return self.session_start.time()
     
-    @property
+    @cached_property
     def session_stop(self):
-        return self.expframe_ts_data.index[-1] + pd.Timedelta(seconds=7200)
+        return self._session_bounds[1] + pd.Timedelta(seconds=7200)
     
     @property
     def session_length(self):
@@ -201,4 +601,26 @@ class MarmosetSessionData():
     
     @property
     def reward_events_per_min(self):
-        return self.n_reward_events /(self.session_length.total_seconds()/60)
\ No newline at end of file
+        return self.n_reward_events /(self.session_length.total_seconds()/60)
+
+    @property
+    def catalog_entry(self):
+        # one row of the dataset session catalog
+        manifest = read_preproc_manifest(self._preproc_path) if self._preproc_path else None
+        if manifest is not None:
+            streams = [attr for attr, fname in self._preproc_streams().items() 
+                       if manifest["outputs"].get(fname)]
+        else:
+            streams = [attr for attr in self._preproc_streams() 
+                       if getattr(self, attr) is not None]
+        has_rewards = "reward_data" in streams
+        return {"session_path": self.data_path,
+                "session_name": self.session_name,
+                "session_start": self.session_start,
+                "session_stop": self.session_stop,
+                "session_length": self.session_length,
+                "n_reward_events": self.n_reward_events if has_rewards else np.nan,
+                "reward_delivered_ml": self.reward_delivered_ml if has_rewards else np.nan,
+                "reward_events_per_min": self.reward_events_per_min if has_rewards else np.nan,
+                "streams": ";".join(streams),
+                "preproc_version": manifest["version"] if manifest else np.nan}
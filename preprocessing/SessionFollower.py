@@ -0,0 +1,249 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+
+from .data_utils import unix2pd_datetime
+from .data_utils import datetime2ns
+from .data_utils import detect_threshold_edges
+from .data_utils import pair_edges
+from .data_utils import binary_intervals
+from .data_utils import intervals2frame
+from .data_utils import frame_intervals
+from .data_io import read_appended_bytes
+from .data_io import parse_sensor_lines
+from .data_io import parse_reward_lines
+from .data_io import _split_sensor_chunk
+from .TimestampIntegrity import TimestampIntegrity
+from .StreamingTimeFilter import StreamingTimeFilter
+
+from general_modules.config import *
+
+class SessionFollower:
+    """
+    Incremental preprocessing of a running session.
+
+    Every `update` reads only the complete lines appended to `sensor_data.csv`,
+    `reward.log` and the frameGrabber stdout files since the last update, a
+    partially written last line is read with the next update. The new samples
+    advance the streaming state of every stream (lick intervals, distance
+    filter, frame render detection, reward counters), so an update costs time
+    proportional to the new data, not to the session length.
+
+    Usage:
+    - `follower = SessionFollower(data_path, metad, logger)`
+    - `follower.update()` periodically, returns the `metrics`.
+    - `follower.stream("lick_data")` for the stream so far, a pandas object
+      like the preprocessed one (built on access, cached until the next update).
+
+    Attributes:
+    - metrics (dict): Up to date session metrics.
+    """
+    CAM_TS_FNAMES = {"frontcam": FRONT_CAM_TS_FNAME, "scenecam": SCENE_CAM_TS_FNAME,
+                     "facecam": FACE_CAM_TS_FNAME}
+
+    def __init__(self, data_path, metad, logger, max_read_bytes=LIVE_MAX_READ_BYTES):
+        """
+        Args:
+        - data_path (str): Session directory.
+        - metad (dict): Session metadata.
+        - logger (CustomLogger): Logger.
+        - max_read_bytes (int): Max. bytes read from a file at once, catching
+          up with a long running session takes several reads.
+        """
+        self._data_path = data_path
+        self._metad = metad
+        self._logger = logger
+        self._max_read_bytes = max_read_bytes
+        self._offsets = {}
+
+        self._sensor_columns = None
+        self._integrity = TimestampIntegrity(repair=SENSOR_TS_REPAIR)
+        self._sensor_chunks = {}
+        self._lick_carry = None
+        self._licks = ([], [])
+        # the first samples are held back until the window is estimated
+        self._dist_filter = StreamingTimeFilter.for_distance_sensor(metad)
+        self._dist = ([], [])
+        self._photores_carry = None
+        self._edges = ([], [])
+        self._rewards = []
+        self._onoff = []
+        self._frames = {cam: [] for cam in self.CAM_TS_FNAMES}
+        self._streams = {}
+
+        self.metrics = {"first_sample": None, "last_sample": None,
+                        "session_length": pd.Timedelta(0), "n_sensor_samples": 0,
+                        "n_licks": 0, "licking": False, "distance": np.nan,
+                        "n_reward_events": 0, "reward_delivered_ml": 0.,
+                        "reward_events_per_min": np.nan, "reward_on": None,
+                        "n_frames": {cam: 0 for cam in self.CAM_TS_FNAMES}}
+
+    def update(self):
+        """
+        Process the data appended since the last update.
+
+        Returns:
+        - dict: The updated `metrics`.
+        """
+        self._streams = {}
+        self._read_appended(SENSOR_DATA_FNAME, self._update_sensors)
+        self._read_appended(REWARD_DATA_FNAME, self._update_rewards)
+        for cam, ts_fname in self.CAM_TS_FNAMES.items():
+            self._read_appended(ts_fname, lambda data: self._update_frames(cam, data))
+
+        metrics = self.metrics
+        if metrics["first_sample"] is not None:
+            metrics["session_length"] = metrics["last_sample"] -metrics["first_sample"]
+            minutes = metrics["session_length"].total_seconds() /60
+            if minutes > 0:
+                metrics["reward_events_per_min"] = metrics["n_reward_events"] /minutes
+        return metrics
+
+    def _read_appended(self, fname, process):
+        # until caught up, in pieces of at most max_read_bytes
+        full_fname = os.path.join(self._data_path, fname)
+        if not os.path.exists(full_fname):
+            return
+        size = os.path.getsize(full_fname)
+        offset = self._offsets.get(fname, 0)
+        if size < offset:
+            self._logger.warning(f"{full_fname} shrank, it's not followed anymore.")
+            return
+        while offset < size:
+            data, offset = read_appended_bytes(full_fname, offset, self._max_read_bytes)
+            if not data:
+                # partially written line
+                break
+            process(data)
+        self._offsets[fname] = offset
+
+    def _update_sensors(self, data):
+        if self._sensor_columns is None:
+            header, _, data = data.partition(b"\n")
+            self._sensor_columns = header.decode().strip().split(",")
+            if not data:
+                return
+        try:
+            chunk = parse_sensor_lines(data, self._sensor_columns)
+        except pd.errors.ParserError as e:
+            self._logger.error(f"{e} {len(data)} appended bytes of sensor data are skipped.")
+            return
+        except pd.errors.EmptyDataError:
+            # only blank lines appended
+            return
+        _split_sensor_chunk(chunk, self._sensor_chunks, self._integrity)
+
+        for sensor_id, chunks in self._sensor_chunks.items():
+            if not chunks:
+                continue
+            tstamps, values = zip(*chunks)
+            tstamps, values = np.concatenate(tstamps), np.concatenate(values)
+            chunks.clear()
+            if not len(tstamps):
+                continue
+            if sensor_id == LICK_SENSOR_ID:
+                self._update_licks(tstamps, values)
+            elif sensor_id == DISTANCELEFT_SENSOR_ID:
+                self._update_dist(tstamps, values)
+            elif sensor_id == PHTOTRES_SENSOR_ID:
+                self._update_photores(tstamps, values)
+            first, last = tstamps[0], tstamps[-1]
+            if self.metrics["first_sample"] is None or first < self.metrics["first_sample"].value:
+                self.metrics["first_sample"] = pd.Timestamp(first)
+            if self.metrics["last_sample"] is None or last > self.metrics["last_sample"].value:
+                self.metrics["last_sample"] = pd.Timestamp(last)
+            self.metrics["n_sensor_samples"] += len(tstamps)
+
+    def _update_licks(self, tstamps, values):
+        starts, ends, self._lick_carry = binary_intervals(tstamps, values, self._lick_carry)
+        self._licks[0].append(starts)
+        self._licks[1].append(ends)
+        self.metrics["n_licks"] += len(starts)
+        self.metrics["licking"] = self._lick_carry[2] is not None
+
+    def _update_dist(self, tstamps, values):
+        tstamps, filtered = self._dist_filter.update(tstamps, values)
+        if not len(tstamps):
+            return
+        self._dist[0].append(tstamps)
+        self._dist[1].append(filtered)
+        self.metrics["distance"] = float(filtered[-1])
+
+    def _update_photores(self, tstamps, values):
+        rising, falling, self._photores_carry = detect_threshold_edges(
+            tstamps, values, PHOTORES_BLOCK_MS*10**6, PHOTORES_HYSTERESIS,
+            PHOTORES_MIN_AMPLITUDE, self._photores_carry, last_chunk=False)
+        self._edges[0].append(rising)
+        self._edges[1].append(falling)
+
+    def _update_rewards(self, data):
+        lines = pd.Series(data.decode(errors="replace").splitlines(), dtype=object)
+        reward_events, onoff_switches = parse_reward_lines(lines, self._logger)
+        self._rewards.append(datetime2ns(reward_events.index))
+        self._onoff.append(onoff_switches)
+        self.metrics["n_reward_events"] += len(reward_events)
+        self.metrics["reward_delivered_ml"] = (self.metrics["n_reward_events"]
+                                               *self._metad["rewardVolume"] /1000)
+        if len(onoff_switches):
+            self.metrics["reward_on"] = bool(onoff_switches.iloc[-1] == 1)
+
+    def _update_frames(self, cam, data):
+        try:
+            tstamps = pd.read_csv(io.BytesIO(data), sep=" ", header=None).iloc[:,1].values
+        except pd.errors.ParserError as e:
+            self._logger.error(f"{e} {len(data)} appended bytes of {cam} timestamps "
+                               f"are skipped.")
+            return
+        except pd.errors.EmptyDataError:
+            # only blank lines appended
+            return
+        self._frames[cam].append(datetime2ns(unix2pd_datetime(tstamps)))
+        self.metrics["n_frames"][cam] += len(tstamps)
+
+    def stream(self, attr):
+        """
+        A stream of the session so far, like the preprocessed one.
+
+        Args:
+        - attr (str): Stream attribute name of `MarmosetSessionData`.
+
+        Returns:
+        - pd.Series or pd.DataFrame: The stream, None if there is no data (yet)
+          or the stream isn't followed (alignments).
+        """
+        if attr not in self._streams:
+            self._streams[attr] = self._build_stream(attr)
+        return self._streams[attr]
+
+    def _build_stream(self, attr):
+        if attr == "lick_data" and self._licks[0]:
+            return intervals2frame(*map(np.concatenate, self._licks))
+        if attr == "dist_left_data" and self._dist[0]:
+            tstamps, filtered = map(np.concatenate, self._dist)
+            index = pd.DatetimeIndex(tstamps.view("datetime64[ns]"),
+                                     name=SENSOR_CSV_TIMESTAMP_COLUMN)
+            return pd.Series(filtered, index=index, name=DISTANCELEFT_SENSOR_ID)
+        if attr == "expframe_ts_data" and self._photores_carry is not None:
+            # the last block is still carried, flush it without changing the 
+            # carry, the next update detects its edges again with more samples
+            rising, falling, _ = detect_threshold_edges(
+                np.empty(0, dtype=np.int64), np.empty(0), PHOTORES_BLOCK_MS*10**6,
+                PHOTORES_HYSTERESIS, PHOTORES_MIN_AMPLITUDE, self._photores_carry,
+                last_chunk=True)
+            starts, ends = pair_edges(np.concatenate(self._edges[0] +[rising]),
+                                      np.concatenate(self._edges[1] +[falling]),
+                                      PHOTORES_DEBOUNCE_MS*10**6)
+            return intervals2frame(starts, ends)
+        if attr == "reward_data" and self._rewards:
+            return pd.Series(True, pd.DatetimeIndex(np.concatenate(self._rewards)
+                                                    .view("datetime64[ns]")),
+                             name='reward_events')
+        if attr == "onoff_swtiches" and self._onoff:
+            return pd.concat(self._onoff)
+        cam = attr[:-len("_ts")]
+        if attr.endswith("_ts") and self._frames.get(cam):
+            starts = np.concatenate(self._frames[cam])
+            if len(starts) > 1:
+                return frame_intervals(pd.Index(starts.view("datetime64[ns]")),
+                                       self._metad["cameraFPS"])
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+
+class StageScheduler:
+    """
+    A small DAG scheduler that runs independent preprocessing stages
+    concurrently in a thread pool.
+
+    Usage:
+    - Register stages with `add_stage`, a stage starts once all the stages it
+      depends on finished successfully. Dependencies on stages that were not
+      registered are ignored (their data is already available).
+    - Call `run` to execute all stages. Stages depending on a failed stage are
+      skipped.
+
+    Attributes:
+    - stage_results (dict): Per stage status (`done`, `failed`, `skipped`),
+      wall time in seconds, profile (see `CustomLogger.profile`), return value
+      and error.
+    """
+
+    def __init__(self, n_workers, logger):
+        """
+        Args:
+        - n_workers (int): Number of worker threads.
+        - logger (CustomLogger): Logger for stage failures and profiles.
+        """
+        self._n_workers = n_workers
+        self._logger = logger
+        self._stages = {}
+        self.stage_results = {}
+
+    def add_stage(self, name, func, depends_on=()):
+        """
+        Register a stage.
+
+        Args:
+        - name (str): Unique stage name.
+        - func (callable): Called without arguments when the stage runs.
+        - depends_on (tuple): Names of stages that have to finish first.
+        """
+        self._stages[name] = (func, tuple(depends_on))
+
+    def run(self):
+        """
+        Run all registered stages, return the stage results.
+        """
+        waiting = {name: {d for d in depends_on if d in self._stages}
+                   for name, (_, depends_on) in self._stages.items()}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self._n_workers) as executor:
+            while waiting or running:
+                n_waiting = len(waiting)
+                for name in list(waiting):
+                    statuses = [self.stage_results.get(d, {}).get("status")
+                                for d in waiting[name]]
+                    if any(s in ("failed", "skipped") for s in statuses):
+                        self.stage_results[name] = {"status": "skipped",
+                                                    "wall_time": 0, "profile": None,
+                                                    "result": None, "error": None}
+                        del waiting[name]
+                    elif all(s == "done" for s in statuses):
+                        func = self._stages[name][0]
+                        self._logger.debug(f"Starting stage `{name}`")
+                        running[executor.submit(self._run_stage, name, func)] = name
+                        del waiting[name]
+                if not running:
+                    if len(waiting) == n_waiting:
+                        raise ValueError(f"Cyclic stage dependencies: {list(waiting)}")
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    self.stage_results[name] = future.result()
+                    if self.stage_results[name]["status"] == "failed":
+                        self._logger.error(f"Stage `{name}` failed: "
+                                           f"{self.stage_results[name]['error']}")
+        return self.stage_results
+
+    def raise_for_failed(self):
+        """
+        Re-raise the error of the first failed stage, if any.
+        """
+        for result in self.stage_results.values():
+            if result["status"] == "failed":
+                raise result["error"]
+
+    def _run_stage(self, name, func):
+        result, error, status = None, None, "done"
+        try:
+            with self._logger.profile(f"stage {name}") as profile:
+                result = func()
+        except Exception as e:
+            error, status = e, "failed"
+        return {"status": status, "wall_time": profile["wall_time"], 
+                "profile": profile, "result": result, "error": error}
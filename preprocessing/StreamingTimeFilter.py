@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from .data_utils import rolling_time_filter
+
+from general_modules.config import *
+
+class StreamingTimeFilter:
+    """
+    Trailing time window filter (`rolling_time_filter`) of a sensor stream that
+    arrives in chunks, e.g. while the sensor file is read or followed.
+
+    The window is either fixed or `window_samples` median sampling intervals
+    long, estimated from the first `estimate_samples` samples. These are held
+    back until the window is known, the result doesn't depend on the chunking.
+
+    Usage:
+    - `filt = StreamingTimeFilter("mean", window_samples=10)`
+    - `tstamps, filtered = filt.update(tstamps, values)` for every chunk, in
+      time order, returns the samples filtered by this call.
+    - `tstamps, filtered = filt.flush()` after the last chunk.
+
+    Attributes:
+    - how (str): The filter.
+    - window (pd.Timedelta): The window, None until it's estimated.
+    """
+    def __init__(self, how, window=None, window_samples=None,
+                 estimate_samples=DIST_SENSOR_WINDOW_EST_SAMPLES):
+        """
+        Args:
+        - how (str): `mean`, `median` or `min`.
+        - window (pd.Timedelta, optional): Fixed window length.
+        - window_samples (int, optional): Window length in median sampling
+          intervals, if no fixed window is given.
+        - estimate_samples (int): Number of samples to estimate the median
+          sampling interval from.
+        """
+        if window is None and window_samples is None:
+            raise ValueError("Either a window or window_samples is needed.")
+        self.how = how
+        self.window = window
+        self._window_samples = window_samples
+        self._estimate_samples = max(estimate_samples, 2)
+        self._pending = []
+        self._n_pending = 0
+        self._carry = None
+
+    @classmethod
+    def for_distance_sensor(cls, metad):
+        """
+        Filter of the distance sensor as configured in the session metadata.
+
+        Args:
+        - metad (dict): Session metadata.
+
+        Returns:
+        - StreamingTimeFilter: The filter.
+        """
+        how = metad.get("dist_sensor_filter", DIST_SENSOR_FILTER)
+        if metad.get("dist_sensor_window_ms") is not None:
+            return cls(how, window=pd.Timedelta(milliseconds=metad["dist_sensor_window_ms"]))
+        return cls(how, window_samples=metad["dist_sensor_mean_windowsize"])
+
+    def update(self, tstamps, values):
+        """
+        Filter the next chunk.
+
+        Args:
+        - tstamps (np.ndarray): Sorted int64 ns timestamps, after the previous
+          chunk's.
+        - values (np.ndarray): Sensor values.
+
+        Returns:
+        - tuple: int64 timestamps and float32 filtered values of the samples
+          filtered by this call.
+        """
+        if self.window is None:
+            self._pending.append((tstamps, values))
+            self._n_pending += len(tstamps)
+            if self._n_pending < self._estimate_samples:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            return self.flush()
+        return self._filter(tstamps, values)
+
+    def flush(self):
+        """
+        Filter the held back samples, the window is estimated from fewer
+        samples if the stream ends early.
+
+        Returns:
+        - tuple: Like `update`.
+        """
+        if not self._pending:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        tstamps, values = map(np.concatenate, zip(*self._pending))
+        self._pending, self._n_pending = [], 0
+        if self.window is None:
+            deltatimes = np.diff(tstamps[:self._estimate_samples])
+            median_dt = np.median(deltatimes) if deltatimes.size else 0
+            self.window = pd.Timedelta(self._window_samples *max(median_dt, 1), unit='ns')
+        return self._filter(tstamps, values)
+
+    def _filter(self, tstamps, values):
+        chunk = pd.Series(values, index=pd.DatetimeIndex(tstamps.view("datetime64[ns]")))
+        filtered, self._carry = rolling_time_filter(chunk, self.window, self.how,
+                                                    self._carry)
+        return tstamps, filtered
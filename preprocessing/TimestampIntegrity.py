@@ -0,0 +1,243 @@
+import numpy as np
+
+from general_modules.config import *
+
+class TimestampIntegrity:
+    """
+    Streaming integrity check of a timestamp series, with optional repair.
+
+    Every chunk is checked in one pass for
+    - corrupt timestamps: more than `max_offset_s` away from the reference
+      (median of the first chunk), e.g. `1.696e+17` instead of `1.696e+09`,
+      or missing (NaT),
+    - non-monotonic rows: before the latest timestamp seen so far, every
+      backward jump starts a non-monotonic segment,
+    - duplicate rows: same timestamp and keys (e.g. sensor id, value and
+      arduino timestamp) as the previous row.
+    The time deltas of the clean rows are accumulated in a fixed size
+    histogram, median, STD and out of distribution counts are derived from it
+    in `report`. The cost is linear in the number of rows, the number of checks
+    only adds a constant per report.
+
+    Usage:
+    - `integrity = TimestampIntegrity(repair="drop")`
+    - `tstamps, keep = integrity.update(tstamps, keys=(ids, values))` for
+      every chunk, in order.
+    - `integrity.report()` for the counts and statistics, `integrity.log(logger)`.
+
+    Attributes:
+    - n_rows, n_corrupt, n_non_monotonic, n_backward_jumps, n_duplicates,
+      n_dropped (int): Counts so far.
+    """
+    MAX_EXAMPLES = 10
+
+    def __init__(self, repair=None, max_offset_s=TS_MAX_OFFSET_S,
+                 hist_resolution_us=TS_DELTA_HIST_RESOLUTION_US,
+                 hist_max_ms=TS_DELTA_HIST_MAX_MS):
+        """
+        Args:
+        - repair (str, optional): None to only report, `drop` to drop corrupt,
+          non-monotonic and duplicate rows, `repair` to interpolate corrupt
+          timestamps from their neighbours and drop the others.
+        - max_offset_s (float): Max. distance from the reference timestamp.
+        - hist_resolution_us (float): Resolution of the delta histogram.
+        - hist_max_ms (float): Larger deltas fall into one overflow bin.
+        """
+        if repair not in (None, "drop", "repair"):
+            raise ValueError(f"Unknown repair mode `{repair}`")
+        self._repair = repair
+        self._max_offset = int(max_offset_s *1e9)
+        self._res = max(int(hist_resolution_us *1e3), 1)
+        # last bin: overflow
+        self._hist = np.zeros(int(hist_max_ms *1e6) //self._res +1, dtype=np.int64)
+        self._delta_sum = 0.
+        self._delta_sumsq = 0.
+
+        self._ref = None
+        self._prev_t = None  # last row, for duplicates
+        self._prev_keys = None
+        self._prev_non_monotonic = False
+        self._max_t = None  # latest valid timestamp
+        self._last_clean_t = None  # for deltas and interpolation
+        self._examples = {"corrupt": [], "non_monotonic": [], "duplicate": []}
+
+        self.n_rows = 0
+        self.n_corrupt = 0
+        self.n_non_monotonic = 0
+        self.n_backward_jumps = 0
+        self.n_duplicates = 0
+        self.n_dropped = 0
+
+    def update(self, tstamps, keys=()):
+        """
+        Check the next chunk.
+
+        Args:
+        - tstamps (np.ndarray): Timestamps, int64 ns (NaT as int64 min).
+        - keys (tuple): Arrays that also have to match for a duplicate row.
+
+        Returns:
+        - tuple: Timestamps (repaired if repairing), boolean mask of the rows
+          to keep (all True if only reporting).
+        """
+        t = np.asarray(tstamps, dtype=np.int64)
+        n = len(t)
+        if not n:
+            return t, np.ones(0, dtype=bool)
+        if self._ref is None:
+            self._ref = int(np.median(t))
+
+        corrupt = (t < self._ref -self._max_offset) | (t > self._ref +self._max_offset)
+        if self._repair == "repair" and corrupt.any():
+            t = self._interpolate(t, corrupt)
+            valid = np.ones(n, dtype=bool)
+        else:
+            valid = ~corrupt
+
+        # before the latest valid timestamp of all previous rows
+        int_min = np.iinfo(np.int64).min
+        init = self._max_t if self._max_t is not None else int_min
+        prior_max = np.maximum.accumulate(np.concatenate([[init], np.where(valid, t, int_min)]))
+        non_monotonic = valid & (t < prior_max[:-1])
+        prev_non_monotonic = np.concatenate([[self._prev_non_monotonic],
+                                             non_monotonic[:-1]])
+        backward_jumps = non_monotonic & ~prev_non_monotonic
+
+        prev_t = self._prev_t if self._prev_t is not None else int_min
+        duplicate = valid & ~non_monotonic & (t == np.concatenate([[prev_t], t[:-1]]))
+        for i, key in enumerate(keys):
+            key = np.asarray(key)
+            prev_key = (key[:1] if self._prev_keys is None 
+                        else np.array([self._prev_keys[i]], dtype=key.dtype))
+            duplicate &= key == np.concatenate([prev_key, key[:-1]])
+
+        clean = valid & ~non_monotonic & ~duplicate
+        self._add_deltas(t[clean])
+        self._count(corrupt, non_monotonic, backward_jumps, duplicate)
+
+        self._prev_t = t[-1]
+        self._prev_keys = [np.asarray(key)[-1] for key in keys]
+        self._prev_non_monotonic = non_monotonic[-1]
+        self._max_t = int(prior_max[-1]) if prior_max[-1] != int_min else None
+        self.n_rows += n
+
+        keep = clean if self._repair is not None else np.ones(n, dtype=bool)
+        self.n_dropped += n -int(np.count_nonzero(keep))
+        return t, keep
+
+    def _interpolate(self, t, corrupt):
+        # linear in the row number between the closest valid timestamps, as
+        # offsets to the reference (exact in float64)
+        t = t.copy()
+        rows = np.arange(len(t))
+        anchor_rows, anchor_t = rows[~corrupt], (t[~corrupt] -self._ref).astype(np.float64)
+        if self._last_clean_t is not None:
+            anchor_rows = np.concatenate([[-1], anchor_rows])
+            anchor_t = np.concatenate([[self._last_clean_t -self._ref], anchor_t])
+        if not len(anchor_rows):
+            # nothing to interpolate from, fall back to the reference
+            t[corrupt] = self._ref
+            return t
+        interpolated = np.interp(rows[corrupt], anchor_rows, anchor_t)
+        t[corrupt] = np.round(interpolated).astype(np.int64) +self._ref
+        return t
+
+    def _add_deltas(self, t):
+        if not len(t):
+            return
+        prepend = self._last_clean_t if self._last_clean_t is not None else t[0]
+        deltas = np.diff(t, prepend=prepend)
+        if self._last_clean_t is None:
+            deltas = deltas[1:]
+        self._last_clean_t = t[-1]
+
+        bins = np.minimum(deltas //self._res, len(self._hist)-1)
+        if len(bins) < len(self._hist):
+            np.add.at(self._hist, bins, 1)
+        else:
+            self._hist += np.bincount(bins, minlength=len(self._hist))
+        deltas_ms = deltas /1e6
+        self._delta_sum += deltas_ms.sum()
+        self._delta_sumsq += (deltas_ms**2).sum()
+
+    def _count(self, corrupt, non_monotonic, backward_jumps, duplicate):
+        for kind, mask in (("corrupt", corrupt), ("non_monotonic", backward_jumps),
+                           ("duplicate", duplicate)):
+            examples = self._examples[kind]
+            if len(examples) < self.MAX_EXAMPLES and mask.any():
+                rows = np.flatnonzero(mask)[:self.MAX_EXAMPLES-len(examples)]
+                examples.extend((rows +self.n_rows).tolist())
+        self.n_corrupt += int(np.count_nonzero(corrupt))
+        self.n_non_monotonic += int(np.count_nonzero(non_monotonic))
+        self.n_backward_jumps += int(np.count_nonzero(backward_jumps))
+        self.n_duplicates += int(np.count_nonzero(duplicate))
+
+    def report(self):
+        """
+        Counts and delta time statistics (ms) of the rows checked so far.
+
+        Returns:
+        - dict: Counts, row numbers of the first anomalies of every kind
+          (`examples`), and the median, STD and number of clean deltas within
+          1 ms and 1, 2, 3 STD around the median, and out of distribution.
+          Median and bounds have the resolution of the delta histogram.
+        """
+        n_deltas = int(self._hist.sum())
+        report = {"n_rows": self.n_rows, "n_corrupt": self.n_corrupt,
+                  "n_non_monotonic": self.n_non_monotonic,
+                  "n_backward_jumps": self.n_backward_jumps,
+                  "n_duplicates": self.n_duplicates, "n_dropped": self.n_dropped,
+                  "repair": self._repair, "n_deltas": n_deltas,
+                  "examples": {kind: list(rows) for kind, rows in self._examples.items()}}
+        if not n_deltas:
+            return report
+
+        centers = (np.arange(len(self._hist)) +.5) *self._res /1e6
+        median_bin = np.searchsorted(np.cumsum(self._hist), (n_deltas+1) /2)
+        med = centers[min(median_bin, len(centers)-1)]
+        mean = self._delta_sum /n_deltas
+        std = np.sqrt(max(self._delta_sumsq /n_deltas -mean**2, 0))
+        report.update({"median_ms": float(med), "std_ms": float(std)})
+
+        # deltas in the overflow bin are never within
+        counts, centers = self._hist[:-1], centers[:-1]
+        for key, delta in (("within_1ms", 1), ("within_1std", std),
+                           ("within_2std", 2*std), ("within_3std", 3*std)):
+            within = (centers < med+delta) & (centers > max(med-delta, 0))
+            report[key] = int(counts[within].sum())
+        report["n_ood"] = n_deltas -report["within_3std"]
+        return report
+
+    def log(self, logger, name=""):
+        """
+        Log the report, a warning if anomalies were found.
+
+        Args:
+        - logger (CustomLogger): Logger.
+        - name (str): Name of the checked series.
+        """
+        report = self.report()
+        msg = [f"Timestamp integrity {name}: {report['n_rows']} rows"]
+        if report["n_deltas"]:
+            med, std, n = report["median_ms"], report["std_ms"], report["n_deltas"]
+            msg.append(f"Median: {med:.3f}, STD: {std:.3f}")
+            for label, key, delta in (("1 ms", "within_1ms", 1),
+                                      ("1 STD", "within_1std", std),
+                                      ("2 STD", "within_2std", 2*std),
+                                      ("3 STD", "within_3std", 3*std)):
+                msg.append((f"Within {label} ({max(med-delta,0):.3f} ms - "
+                            f"{med+delta:.3f} ms): {report[key]*100/n:.1f}%"))
+            msg.append(f"Out of distribution deltatimes: {report['n_ood']}")
+        logger.info(msg)
+
+        anomalies = [(report["n_corrupt"], "corrupt timestamps", "corrupt"),
+                     (report["n_non_monotonic"], "non-monotonic rows in "
+                      f"{report['n_backward_jumps']} segments", "non_monotonic"),
+                     (report["n_duplicates"], "duplicate rows", "duplicate")]
+        anomalies = [(f"{count} {label}, first rows: {report['examples'][kind]}")
+                     for count, label, kind in anomalies if count]
+        if anomalies:
+            action = {None: "They are kept.", "drop": "They are dropped.",
+                      "repair": "Corrupt timestamps are interpolated, the other "
+                                "rows dropped."}[self._repair]
+            logger.warning([f"Timestamp anomalies {name}:"] + anomalies + [action])
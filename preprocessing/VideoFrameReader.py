@@ -0,0 +1,167 @@
+import cv2
+import numpy as np
+from collections import OrderedDict
+
+from .data_utils import asof_indices
+from .video_utils import open_video
+from .video_utils import probe_video
+from .video_utils import release_cap
+
+from general_modules.config import *
+
+class VideoFrameReader:
+    """
+    Random access to single frames of a video without decoding the whole file.
+
+    Requested frames are sorted and decoded in one forward pass: a frame close
+    after the current position is reached by grabbing (decoding without
+    converting) the frames in between, a frame further away by seeking, which
+    jumps to the keyframe before it and decodes forward from there. Decoded
+    (and cropped) frames are kept in a size bounded LRU cache.
+
+    Usage:
+    - `reader = VideoFrameReader(video_file, logger, frame_ts=session.facecam_ts)`
+    - `reader.get_frames([10, 11, 5000])` by frame index, or
+      `reader.get_frames_at(session.reward_data.index)` by timestamp.
+    - `reader.close()`, or use it as a context manager.
+
+    Attributes:
+    - n_decoded (int): Number of frames decoded, including grabbed ones.
+    - n_seeks (int): Number of seeks.
+    """
+
+    def __init__(self, video_file, logger, frame_ts=None, crop=None, flip=False,
+                 cache_size_mb=VIDEO_FRAME_CACHE_MB,
+                 max_forward_decode=VIDEO_MAX_FORWARD_DECODE):
+        """
+        Args:
+        - video_file (str): Video file name.
+        - logger (CustomLogger): Logger.
+        - frame_ts (pd.DataFrame, optional): Camera frame table (`start`
+          column) of the video, needed for `get_frames_at`.
+        - crop (tuple, optional): (y, x, width) square crop like FACE_CAM_CROP.
+        - flip (bool): Flip the frames vertically (after cropping).
+        - cache_size_mb (float): Max. size of the frame cache.
+        - max_forward_decode (int): Frames further ahead than this are
+          reached by seeking instead of decoding forward.
+        """
+        self._video_file = video_file
+        self._logger = logger
+        self._frame_ts = frame_ts
+        self._crop = crop
+        self._flip = flip
+        self._cache_size = cache_size_mb *2**20
+        self._max_forward_decode = max_forward_decode
+
+        self._vid_cap = open_video(video_file, logger)
+        if self._vid_cap is None:
+            raise IOError(f"Could not open the video file: {video_file}")
+        # the container frame count is only an estimate, truncated videos 
+        # decode fewer frames
+        self._frame_count = probe_video(video_file, logger)["frame_count"]
+        self._pos = 0  # index of the frame the next read returns
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+        self.n_decoded = 0
+        self.n_seeks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._frame_count
+
+    def close(self):
+        release_cap(self._vid_cap)
+        self._vid_cap = None
+        self._cache.clear()
+        self._cache_nbytes = 0
+
+    def get_frames(self, frame_indices):
+        """
+        Get frames by index.
+
+        Args:
+        - frame_indices (array-like): Frame indices, in any order, repeats
+          are decoded once.
+
+        Returns:
+        - list: Frames (np.ndarray, shared with the cache, don't modify) in 
+          the requested order, None for frames that are out of range or could
+          not be decoded.
+        """
+        frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        frames = {}
+        missing = []
+        for idx in np.unique(frame_indices):
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                frames[idx] = self._cache[idx]
+            elif 0 <= idx < self._frame_count:
+                missing.append(idx)
+
+        for idx in missing:
+            frames[idx] = self._decode_frame(idx)
+            if frames[idx] is not None:
+                self._cache_frame(idx, frames[idx])
+        return [frames.get(idx) for idx in frame_indices]
+
+    def get_frames_at(self, tstamps):
+        """
+        Get the frames shown at the given timestamps (last frame starting at
+        or before the timestamp).
+
+        Args:
+        - tstamps (array-like): Timestamps, datetime64 or int64 ns.
+
+        Returns:
+        - list: Frames in the requested order, None before the first frame.
+        """
+        if self._frame_ts is None:
+            raise ValueError("Reading frames by timestamp needs `frame_ts`.")
+        # frame table rows are video frame positions (matching 0-indices)
+        return self.get_frames(asof_indices(tstamps, self._frame_ts.start))
+
+    def _decode_frame(self, idx):
+        # requests are sorted, so this moves forward within a batch
+        if not (self._pos <= idx <= self._pos + self._max_forward_decode):
+            self._vid_cap.set(cv2.CAP_PROP_POS_FRAMES, int(idx))
+            self._pos = idx
+            self.n_seeks += 1
+        while self._pos < idx:
+            if not self._vid_cap.grab():
+                self._logger.warning(f"{self._video_file}: could not decode "
+                                     f"frame {self._pos}")
+                self._pos = self._frame_count
+                return
+            self._pos += 1
+            self.n_decoded += 1
+
+        ret, frame = self._vid_cap.read()
+        self._pos += 1
+        self.n_decoded += 1
+        if not ret:
+            self._logger.warning(f"{self._video_file}: could not decode frame {idx}")
+            return
+        return self._transform(frame)
+
+    def _transform(self, frame):
+        if self._crop is not None:
+            x, y, width = self._crop
+            frame = frame[x:x+width, y:y+width]
+        if self._flip:
+            frame = cv2.flip(frame, 0)
+        # crops are views, copy so that the full frame can be freed
+        return np.ascontiguousarray(frame)
+
+    def _cache_frame(self, idx, frame):
+        if frame.nbytes > self._cache_size:
+            return
+        self._cache[idx] = frame
+        self._cache_nbytes += frame.nbytes
+        while self._cache_nbytes > self._cache_size:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_nbytes -= evicted.nbytes
@@ -1,18 +1,180 @@
 import os
+import io
 import json
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no file locks (Windows), staging is disabled
+    fcntl = None
 import numpy as np
 import pandas as pd
 import time
-from datetime import datetime
 
-from .data_utils import check_negative_deltatimes
 from .data_utils import check_video_ts_match
 from .data_utils import unix2pd_datetime
+from .data_utils import datetime2ns
+from .TimestampIntegrity import TimestampIntegrity
+from .data_utils import local_datetime2unix
 
 from .video_utils import check_video_file
 
 from general_modules.config import *
 
+_staging_lock = threading.Lock()
+
+@contextmanager
+def stage_file(full_fname, logger, cache_dir=STAGING_CACHE_DIR,
+               max_gb=STAGING_CACHE_MAX_GB):
+    """
+    Read-through staging cache: path of a local copy of a (NAS) file.
+
+    The file is copied to `cache_dir` on first access. A copy is valid while 
+    its size and mtime match the original (the mtime is copied along). When 
+    the cache would exceed `max_gb`, the least recently used files that are
+    not in use are evicted. Every file lives in its own directory keyed by 
+    the hash of the original path, the directory mtime is the last access.
+
+    The cache is shared by threads and processes: checking and evicting 
+    entries holds a lock file of the cache, readers hold a shared lock on 
+    the pin file of their entry, which eviction skips. The size of a file is
+    reserved before it's copied, so concurrent copies stay within `max_gb`,
+    a file that doesn't fit next to the files in use is read without staging.
+
+    Usage:
+    - `with stage_file(full_fname, logger) as local_fname:` read the local
+      copy inside the block, it isn't evicted before the block is left.
+
+    Args:
+    - full_fname (str): File name.
+    - logger (CustomLogger): Logger.
+    - cache_dir (str, optional): Cache directory, None disables staging.
+    - max_gb (float): Max. size of the cache.
+
+    Yields:
+    - str: The local copy, the original file name if staging is disabled,
+      the file doesn't exist or can't be staged.
+    """
+    if cache_dir is None or fcntl is None:
+        yield full_fname
+        return
+    
+    local_fname, pin = _stage_file(full_fname, logger, cache_dir, max_gb)
+    try:
+        yield local_fname
+    finally:
+        if pin is not None:
+            # releases the shared lock
+            pin.close()
+
+@contextmanager
+def _staging_cache_lock(cache_dir):
+    # flock conflicts between processes and between threads (separate opens)
+    with _staging_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, STAGING_LOCK_FNAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+def _stage_file(full_fname, logger, cache_dir, max_gb):
+    # the file to read and the pinned entry (None if not staged)
+    try:
+        src_stat = os.stat(full_fname)
+    except FileNotFoundError:
+        return full_fname, None
+    max_bytes = max_gb *2**30
+    if src_stat.st_size > max_bytes:
+        return full_fname, None
+    
+    key = hashlib.sha1(os.path.abspath(full_fname).encode()).hexdigest()[:16]
+    entry_path = os.path.join(cache_dir, key)
+    local_fname = os.path.join(entry_path, os.path.basename(full_fname))
+    pin = None
+    try:
+        with _staging_cache_lock(cache_dir):
+            os.makedirs(entry_path, exist_ok=True)
+            pin = open(os.path.join(entry_path, STAGING_PIN_FNAME), 'a')
+            fcntl.flock(pin, fcntl.LOCK_SH)
+            if _is_staged_copy(local_fname, src_stat):
+                os.utime(entry_path)
+                return local_fname, pin
+
+            if not _evict_staged_files(cache_dir, max_bytes -src_stat.st_size, 
+                                       logger, exclude=key):
+                logger.info(f"Staging cache is full with files in use, reading "
+                            f"{full_fname} without staging.")
+                pin.close()
+                return full_fname, None
+            write_txt_file(str(src_stat.st_size), entry_path, STAGING_SIZE_FNAME)
+    except OSError as e:
+        logger.warning(f"{e} Reading {full_fname} without staging.")
+        if pin is not None:
+            pin.close()
+        return full_fname, None
+    
+    # copied outside of the cache lock, other files can be staged concurrently
+    tmp_fname = f"{local_fname}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(os.path.join(entry_path, STAGING_COPY_FNAME), 'a') as copy_lock:
+            fcntl.flock(copy_lock, fcntl.LOCK_EX)
+            if _is_staged_copy(local_fname, src_stat):
+                # copied by another thread or process meanwhile
+                return local_fname, pin
+            logger.info(f"Staging {full_fname} ({src_stat.st_size/2**20:.1f} MB) "
+                        f"to {cache_dir}")
+            shutil.copy2(full_fname, tmp_fname)
+            os.replace(tmp_fname, local_fname)
+        return local_fname, pin
+    except OSError as e:
+        logger.warning(f"{e} Reading {full_fname} without staging.")
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        pin.close()
+        return full_fname, None
+
+def _is_staged_copy(local_fname, src_stat):
+    try:
+        local_stat = os.stat(local_fname)
+    except FileNotFoundError:
+        return False
+    return (local_stat.st_size == src_stat.st_size 
+            and local_stat.st_mtime_ns == src_stat.st_mtime_ns)
+
+def _evict_staged_files(cache_dir, max_bytes, logger, exclude=None):
+    # least recently used entries that are not in use first, until the cache
+    # fits in max_bytes, returns whether it does
+    entries = []
+    with os.scandir(cache_dir) as cache_entries:
+        for entry in cache_entries:
+            if entry.is_dir() and entry.name != exclude:
+                entries.append((entry.stat().st_mtime, _staged_entry_size(entry.path), 
+                                entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        with open(os.path.join(entry.path, STAGING_PIN_FNAME), 'a') as pin:
+            try:
+                fcntl.flock(pin, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # read by a thread or process
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+        total -= size
+        logger.debug(f"Evicted {entry.name} ({size/2**20:.1f} MB) from the staging cache")
+    return total <= max_bytes
+
+def _staged_entry_size(entry_path):
+    # the reserved size, counts files that are still being copied
+    try:
+        with open(os.path.join(entry_path, STAGING_SIZE_FNAME)) as file:
+            return int(file.read())
+    except (FileNotFoundError, ValueError):
+        return sum(f.stat().st_size for f in os.scandir(entry_path) if f.is_file())
+
 def read_metadata_file(data_path):
     try:
         return read_json(data_path, "metadata.json")
@@ -24,92 +186,228 @@ def read_metadata_file(data_path):
                 "dist_sensor_mean_windowsize": 10,
                 "notes": read_notes_txt_file(data_path, "notes.txt")}
 
-def read_sensor_file(data_path, logger):
+def read_sensor_file(data_path, logger, chunksize=SENSOR_CSV_CHUNKSIZE, 
+                     chunk_filters=None):
+    """
+    Read the sensor CSV file chunk by chunk, split by sensor id.
+
+    Args:
+    - data_path (str): Session directory.
+    - logger (logging.Logger): Logger.
+    - chunksize (int): Rows per chunk.
+    - chunk_filters (dict, optional): Sensor id to `StreamingTimeFilter`, these
+      sensors are filtered chunk by chunk, their raw stream is never held in
+      full. Needs sorted timestamps, i.e. `SENSOR_TS_REPAIR`.
+
+    Returns:
+    - dict: Sensor id to pd.Series, None without a sensor file.
+    """
     logger.info(f"Loading sensor data")
+    chunk_filters = chunk_filters or {}
 
     try:
-        # Read the sensor data CSV file
-        sen_filename = os.path.join(data_path, SENSOR_DATA_FNAME)
-        sensor_d = pd.read_csv(sen_filename).iloc[:-1]
-        sensor_d.drop(["arduino_timestamp", "computer_timestamp"], axis=1, 
-                            inplace=True)
-        
-        mask = check_negative_deltatimes(sensor_d.logging_timestamp, logger)
-        sensor_d = sensor_d[~mask]
-        sensor_d.logging_timestamp = unix2pd_datetime(sensor_d.logging_timestamp)
+        # Read the sensor data CSV file in chunks, only the needed columns
+        sensor_chunks = {}
+        integrity = TimestampIntegrity(repair=SENSOR_TS_REPAIR)
+        with stage_file(os.path.join(data_path, SENSOR_DATA_FNAME), logger) as sen_filename:
+            columns = pd.read_csv(sen_filename, nrows=0).columns
+            usecols, dtypes = _sensor_csv_columns(columns)
+            reader = pd.read_csv(sen_filename, usecols=usecols, dtype=dtypes, 
+                                 engine='c', chunksize=chunksize)
+            chunk = next(reader, None)
+            while chunk is not None:
+                next_chunk = next(reader, None)
+                if next_chunk is None:
+                    # the last line may be partially written
+                    chunk = chunk.iloc[:-1]
+                _split_sensor_chunk(chunk, sensor_chunks, integrity, chunk_filters)
+                chunk = next_chunk
+        for sensor_id, chunk_filter in chunk_filters.items():
+            if sensor_id in sensor_chunks:
+                sensor_chunks[sensor_id].append(chunk_filter.flush())
+        integrity.log(logger, SENSOR_DATA_FNAME)
+
+        sensor_d = {}
+        for sensor_id, chunks in sensor_chunks.items():
+            tstamps, values = zip(*chunks)
+            index = pd.DatetimeIndex(np.concatenate(tstamps).view("datetime64[ns]"), 
+                                     name=SENSOR_CSV_TIMESTAMP_COLUMN)
+            sensor_d[sensor_id] = pd.Series(np.concatenate(values), index=index, 
+                                            name=sensor_id)
         return sensor_d
 
     except FileNotFoundError as e:
         logger.error(f"\{e} Sensor data will be None.")
         return None
 
+def _sensor_csv_columns(columns):
+    # columns to parse and their dtypes
+    usecols = [col for col in columns if col not in SENSOR_CSV_DROP_COLUMNS]
+    dtypes = {col: np.float32 for col in usecols}
+    dtypes.update({"id": "category", SENSOR_CSV_TIMESTAMP_COLUMN: np.float64,
+                   SENSOR_CSV_ARDUINO_TS_COLUMN: np.float64})
+    return usecols, dtypes
+
+def parse_sensor_lines(data, columns):
+    """
+    Parse complete lines of the sensor CSV file without the header, e.g. bytes
+    appended to the file since the last read.
+
+    Args:
+    - data (bytes): The lines.
+    - columns (list): Column names from the header line.
+
+    Returns:
+    - pd.DataFrame: The parsed columns, like a chunk of `read_sensor_file`.
+    """
+    usecols, dtypes = _sensor_csv_columns(columns)
+    return pd.read_csv(io.BytesIO(data), header=None, names=columns, usecols=usecols,
+                       dtype=dtypes, engine='c')
+
+def _split_sensor_chunk(chunk, sensor_chunks, integrity, chunk_filters=None):
+    # check/repair the timestamps, split the chunk by sensor id in one pass,
+    # optionally filter sensors on the fly
+    if not len(chunk):
+        return
+    # unparsable timestamps become NaT and count as corrupt
+    tstamps = datetime2ns(unix2pd_datetime(chunk[SENSOR_CSV_TIMESTAMP_COLUMN].values))
+    value_col = chunk.columns.drop(["id", SENSOR_CSV_TIMESTAMP_COLUMN, 
+                                    SENSOR_CSV_ARDUINO_TS_COLUMN], errors="ignore")[0]
+    ids, values = chunk["id"].values, chunk[value_col].values
+    # category codes differ between chunks, compare duplicates by sensor order
+    [sensor_chunks.setdefault(sensor_id, []) for sensor_id in ids.categories]
+    sensor_order = {sensor_id: i for i, sensor_id in enumerate(sensor_chunks)}
+    sensor_codes = np.array([sensor_order[sensor_id] for sensor_id in ids.categories]
+                            + [-1])[ids.codes]
+    # samples logged in the same batch share the logging timestamp, the 
+    # arduino timestamp tells them apart (if the file has it)
+    keys = (sensor_codes, values)
+    if SENSOR_CSV_ARDUINO_TS_COLUMN in chunk:
+        keys += (chunk[SENSOR_CSV_ARDUINO_TS_COLUMN].values,)
+    tstamps, mask = integrity.update(tstamps, keys=keys)
+    
+    ids = ids[mask]
+    values = values[mask]
+    valid_tstamps = tstamps[mask]
+    codes = ids.codes
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes[codes>=0], minlength=len(ids.categories)))
+    start = np.count_nonzero(codes<0)  # NaN ids sort first
+    for sensor_id, stop in zip(ids.categories, bounds+start):
+        idx = order[start:stop]
+        sensor_chunk = valid_tstamps[idx], values[idx]
+        if chunk_filters and sensor_id in chunk_filters:
+            sensor_chunk = chunk_filters[sensor_id].update(*sensor_chunk)
+        sensor_chunks[sensor_id].append(sensor_chunk)
+        start = stop
+
 def read_reward_file(data_path, logger):
     logger.info(f"Loading and processing reward data")
 
     try:
-        reward_d_fname = os.path.join(data_path, REWARD_DATA_FNAME)
-        with open(reward_d_fname, 'r') as rew_file:
-            tstamps = []
-            onoff_swtiches = []
-            for line in rew_file:
-                try:
-                    print(line.split(" "))
-                    elements = line.split(" ")
-                    tstamps.append(float(elements[-1]))
-                except ValueError as e:
-                    if elements[-1] in ("ON\n", "OFF\n"):
-                        timestamp_str = " ".join(elements[:2]) 
-                        timestamp_dt = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S,%f")
-                        timestamp_unix = time.mktime(timestamp_dt.timetuple()) + timestamp_dt.microsecond / 1e6
-                        timestamp_unix += 3600
-                        
-                        onoff_swtiches.append((timestamp_unix, (1 if elements[-1]=="ON\n" else -1)))
-                    else:
-                        logger.warning(f"{e} -> Line will be skipped")
-        onoff_swtiches = pd.DataFrame(onoff_swtiches).set_index(0, drop=True).squeeze()
-        return pd.Series(True, unix2pd_datetime(tstamps), name='reward_events'), onoff_swtiches
-
+        with stage_file(os.path.join(data_path, REWARD_DATA_FNAME), logger) as reward_d_fname, \
+             open(reward_d_fname, 'r') as rew_file:
+            lines = pd.Series(rew_file.read().splitlines(), dtype=object)
     except FileNotFoundError as e:
         logger.error(f"{e} - Reward events data will be None.")
-        return None
+        return None, None
     
+    return parse_reward_lines(lines, logger)
+
+def parse_reward_lines(lines, logger):
+    """
+    Parse reward.log lines into reward events and ON/OFF switches.
+
+    Args:
+    - lines (pd.Series): The lines (str).
+    - logger (CustomLogger): Logger for lines that can't be parsed.
+
+    Returns:
+    - tuple: Reward events (pd.Series, True at the reward times), ON/OFF 
+      switches (pd.Series, 1/-1 with a unix timestamp index).
+    """
+    # reward lines end with a unix timestamp, ON/OFF lines start with a date
+    last_elements = lines.str.rsplit(" ", n=1).str[-1]
+    tstamps = pd.to_numeric(last_elements, errors='coerce')
+    is_reward = tstamps.notna()
+    is_onoff = ~is_reward & last_elements.isin(("ON", "OFF"))
+
+    onoff_lines = lines[is_onoff].str.split(" ", n=2)
+    onoff_dt = pd.to_datetime(onoff_lines.str[0] + " " + onoff_lines.str[1], 
+                              format="%Y-%m-%d %H:%M:%S,%f", errors='coerce')
+    is_onoff[is_onoff] = onoff_dt.notna()
+    onoff_dt = onoff_dt.dropna()
+
+    skipped = lines[~is_reward & ~is_onoff]
+    if not skipped.empty:
+        logger.warning([f"{len(skipped)} lines could not be parsed and will be skipped:"]
+                       + [repr(line) for line in skipped.iloc[:10]])
+    
+    onoff_unix = local_datetime2unix(onoff_dt) + 3600
+    onoff_swtiches = pd.Series(np.where(last_elements[is_onoff]=="ON", 1, -1),
+                               index=pd.Index(onoff_unix, name=0), name=1)
+    # re-parse with correctly rounded float conversion (to_numeric isn't)
+    tstamps = last_elements[is_reward].values.astype(np.float64)
+    reward_events = pd.Series(True, unix2pd_datetime(tstamps), 
+                              name='reward_events')
+    return reward_events, onoff_swtiches
+
 def read_video_ts_files(data_path, logger):
     logger.info(f"Loading and processing video, vid-timestamp data")
 
-    frame_tstamps = []
     ts_fnames = (FRONT_CAM_TS_FNAME, SCENE_CAM_TS_FNAME, 
                     FACE_CAM_TS_FNAME)
     vid_fnames = (FRONT_CAM_FNAME, SCENE_CAM_FNAME, 
                     FACE_CAM_FNAME)
-    for i in range(len(ts_fnames)):
-        try:
-            video_ts_file = os.path.join(data_path, ts_fnames[i])
+    return [read_video_ts_file(data_path, ts_fname, vid_fname, logger)
+            for ts_fname, vid_fname in zip(ts_fnames, vid_fnames)]
+
+def read_video_ts_file(data_path, ts_fname, vid_fname, logger):
+    try:
+        with stage_file(os.path.join(data_path, ts_fname), logger) as video_ts_file:
             frame_ts = pd.read_csv(video_ts_file, sep=" ", header=None).iloc[:,1]
-            frame_ts = pd.Index(unix2pd_datetime(frame_ts).values)
+        frame_ts = pd.Index(unix2pd_datetime(frame_ts).values)
 
-            vid_fname = os.path.join(data_path, vid_fnames[i])
-            video_ok = check_video_file(vid_fname, logger)
-            if not video_ok:
-                logger.error(f"Frame timestamps data will be None.")
-                frame_tstamps.append(None)
-                continue
-            
-            check_video_ts_match(frame_ts, vid_fname, logger)
-            frame_tstamps.append(frame_ts)
+        vid_fname = os.path.join(data_path, vid_fname)
+        video_ok = check_video_file(vid_fname, logger)
+        if not video_ok:
+            logger.error(f"Frame timestamps data will be None.")
+            return None
+        
+        check_video_ts_match(frame_ts, vid_fname, logger)
+        return frame_ts
 
-        except FileNotFoundError as e:
-            logger.error(f"{e} Frame timestamps data will be None.")
-            frame_tstamps.append(None)
+    except FileNotFoundError as e:
+        logger.error(f"{e} Frame timestamps data will be None.")
 
-        except pd.errors.ParserError as e:
-            logger.error(f"{e} Frame timestamps data will be None.")
-            frame_tstamps.append(None)
-        
-        except pd.errors.EmptyDataError as e:
-            logger.error(f"{e} Frame timestamps data will be None.")
-            frame_tstamps.append(None)
+    except pd.errors.ParserError as e:
+        logger.error(f"{e} Frame timestamps data will be None.")
+    
+    except pd.errors.EmptyDataError as e:
+        logger.error(f"{e} Frame timestamps data will be None.")
+
+def read_appended_bytes(full_fname, offset, max_bytes=None):
+    """
+    Read the complete lines appended to a growing file since `offset`, a 
+    partially written last line is left for the next read.
 
-    return frame_tstamps
+    Args:
+    - full_fname (str): File name.
+    - offset (int): Byte offset of the first unread line.
+    - max_bytes (int, optional): Read at most this many bytes.
+
+    Returns:
+    - tuple: The lines (bytes, ends with a newline or is empty), offset after 
+      the last complete line. Nothing is read if the file doesn't exist (yet).
+    """
+    try:
+        with open(full_fname, 'rb') as file:
+            file.seek(offset)
+            data = file.read(-1 if max_bytes is None else max_bytes)
+    except FileNotFoundError:
+        return b"", offset
+    complete = data.rfind(b"\n") +1
+    return data[:complete], offset +complete
 
 def read_json(data_path, fname):
     full_fname = os.path.join(data_path, fname)
@@ -123,6 +421,11 @@ def write_dict2json(dic, dest_path, output_fname):
     with open(dest_fname, 'w') as json_file:
         json.dump(dic, json_file, indent=4)
 
+def write_txt_file(text, dest_path, output_fname):
+    dest_fname = os.path.join(dest_path, output_fname)
+    with open(dest_fname, 'w') as file:
+        file.write(text)
+
 def read_notes_txt_file(data_path, fname):
     full_fname = os.path.join(data_path, fname)
     try:
@@ -166,11 +469,358 @@ def read_pkl(data_path, fname, logger):
         return None
 
 
-def load_prepoc_data(data_path, logger):
+def write_preproc_data(dest_path, output_fname, data, logger, 
+                       compress=PREPROC_STORE_COMPRESS):
+    """
+    Write a pandas Series/DataFrame as a directory of columnar numpy arrays.
+
+    Every column and the index is stored as its own .npy file (or together in
+    one compressed .npz), `layout.json` describes how to rebuild the pandas 
+    object. Uncompressed arrays can be memory-mapped on reading.
+    """
+    if data is None:
+        logger.warning(f"{output_fname} is None. No preprocessed data will be saved.")
+        shutil.rmtree(os.path.join(dest_path, output_fname), ignore_errors=True)
+        return
+    
+    if isinstance(data, pd.Series):
+        layout = {"kind": "series", "name": data.name}
+        columns = [data.values]
+    else:
+        layout = {"kind": "frame", "name": list(data.columns)}
+        columns = [data[col].values for col in data.columns]
+    
+    arrays = {f"column_{i}": np.asarray(col) for i, col in enumerate(columns)}
+    if isinstance(data.index, pd.RangeIndex):
+        layout["index"] = {"range": [data.index.start, data.index.stop, 
+                                     data.index.step]}
+    else:
+        arrays["index"] = np.asarray(data.index.values)
+        layout["index"] = {"name": data.index.name}
+    layout["compressed"] = compress
+
+    stream_path = os.path.join(dest_path, output_fname)
+    shutil.rmtree(stream_path, ignore_errors=True)
+    os.makedirs(stream_path)
+    if compress:
+        np.savez_compressed(os.path.join(stream_path, "data.npz"), **arrays)
+    else:
+        [np.save(os.path.join(stream_path, fname+".npy"), arr, allow_pickle=False)
+         for fname, arr in arrays.items()]
+    write_dict2json(layout, stream_path, PREPROC_LAYOUT_FNAME)
+
+def read_preproc_data(data_path, fname, logger, mmap=PREPROC_STORE_MMAP):
+    """
+    Read an output written by `write_preproc_data`. Uncompressed arrays are
+    memory-mapped (read-only) when `mmap` is set. Falls back to the legacy 
+    pickle file if no columnar output exists.
+    """
+    stream_path = os.path.join(data_path, fname)
+    if not os.path.exists(os.path.join(stream_path, PREPROC_LAYOUT_FNAME)):
+        if os.path.exists(os.path.join(data_path, fname + ".pkl")):
+            return read_pkl(data_path, fname, logger)
+        logger.error(f"{stream_path} not found. Data will be None.")
+        return None
+    
+    layout = read_json(stream_path, PREPROC_LAYOUT_FNAME)
+    if layout["compressed"]:
+        with np.load(os.path.join(stream_path, "data.npz")) as npz:
+            arrays = dict(npz)
+    else:
+        mmap_mode = 'r' if mmap else None
+        # plain ndarray views on the memory map, no copy
+        arrays = {fn[:-4]: np.load(os.path.join(stream_path, fn), 
+                                   mmap_mode=mmap_mode).view(np.ndarray)
+                  for fn in os.listdir(stream_path) if fn.endswith(".npy")}
+        
+    if "range" in layout["index"]:
+        index = pd.RangeIndex(*layout["index"]["range"])
+    else:
+        index = pd.Index(arrays["index"], name=layout["index"]["name"], copy=False)
+    
+    if layout["kind"] == "series":
+        return pd.Series(arrays["column_0"], index=index, name=layout["name"], 
+                         copy=False)
+    columns = {col: arrays[f"column_{i}"] for i, col in enumerate(layout["name"])}
+    return pd.DataFrame(columns, index=index, copy=False)
+
+def preproc_output_exists(preproc_path, fname):
+    return (os.path.exists(os.path.join(preproc_path, fname, PREPROC_LAYOUT_FNAME))
+            or os.path.exists(os.path.join(preproc_path, fname + ".pkl")))
+
+def migrate_preproc_pkl(preproc_path, logger, remove_pkl=False):
+    # convert legacy per-output pickles to the columnar store
+    pkl_fnames = sorted(fn for fn in os.listdir(preproc_path) if fn.endswith(".pkl"))
+    for pkl_fname in pkl_fnames:
+        fname = pkl_fname[:-4]
+        write_preproc_data(preproc_path, fname, read_pkl(preproc_path, fname, logger), 
+                           logger)
+        if remove_pkl:
+            os.remove(os.path.join(preproc_path, pkl_fname))
+    logger.info(f"Migrated {len(pkl_fnames)} pickled outputs in {preproc_path}.")
+
+def fingerprint_file(full_fname):
+    # size, mtime and a hash over the whole file, read block by block
+    try:
+        stat = os.stat(full_fname)
+    except FileNotFoundError:
+        return None
+    
+    hasher = hashlib.sha1(str(stat.st_size).encode())
+    with open(full_fname, 'rb') as file:
+        while block := file.read(FINGERPRINT_HASH_BLOCKSIZE):
+            hasher.update(block)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, 
+            "hash": hasher.hexdigest()}
+
+def create_preproc_manifest(data_path, metad, outputs, old_manifest=None):
+    # raw files are inputs of several stages, hash them once, fingerprints of
+    # the previous manifest are reused while size and mtime are unchanged
+    old_fingerprints = {}
+    for stage_manifest in (old_manifest or {}).get("stages", {}).values():
+        old_fingerprints.update({fn: fp for fn, fp in stage_manifest["inputs"].items()
+                                 if fp is not None})
+    fingerprints = {}
+    for fn in {fn for stage_def in PREPROC_STAGES.values() for fn in stage_def["inputs"]}:
+        full_fname = os.path.join(data_path, fn)
+        old_fp = old_fingerprints.get(fn)
+        try:
+            stat = os.stat(full_fname)
+        except FileNotFoundError:
+            fingerprints[fn] = None
+            continue
+        if old_fp is not None and (stat.st_size, stat.st_mtime) == (old_fp["size"], 
+                                                                    old_fp["mtime"]):
+            fingerprints[fn] = old_fp
+        else:
+            fingerprints[fn] = fingerprint_file(full_fname)
+    stages = {}
+    for stage, stage_def in PREPROC_STAGES.items():
+        stages[stage] = {
+            "inputs": {fn: fingerprints[fn] for fn in stage_def["inputs"]},
+            "params": {p: metad.get(p) for p in stage_def["params"]},
+        }
+    return {"version": PREPROC_VERSION, "created": time.time(), 
+            "stages": stages, "outputs": outputs}
+
+def read_preproc_manifest(preproc_path):
+    try:
+        return read_json(preproc_path, PREPROC_MANIFEST_FNAME)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def find_preproc_dir(data_path, preproc_dirs=None):
+    # the preproc directory with the most recent manifest, otherwise the last
+    # one in sorted order (directories without manifest are half-written),
+    # `preproc_dirs`: names from a directory scan, not listed again
+    if preproc_dirs is None:
+        preproc_dirs = [el for el in sorted(os.listdir(data_path)) 
+                        if el.startswith(PREPROC_DIR_PREFIX) 
+                        and os.path.isdir(os.path.join(data_path, el))]
+    preproc_paths = [os.path.join(data_path, el) for el in preproc_dirs]
+    if not preproc_paths:
+        return None
+    
+    created = [(m["created"] if m is not None else -1) 
+               for m in map(read_preproc_manifest, preproc_paths)]
+    return preproc_paths[int(np.argmax(created))]
+
+def scan_session_tree(data_path, logger, exclude_days=(), only_days=()):
+    """
+    Day directories, their session directories and the preproc directories of
+    every session, in one walk with `os.scandir`.
+
+    The result is kept in a manifest in CACHE_DIR. On the next scan a 
+    directory whose mtime didn't change (no entries added, removed or renamed)
+    isn't listed again, only stat-ed. Excluded days are never descended into.
+
+    Args:
+    - data_path (str): Dataset directory (days/sessions).
+    - logger (CustomLogger): Logger.
+    - exclude_days, only_days (list): Day directory names.
+
+    Returns:
+    - dict: Day -> {session: [preproc directory names]}, all sorted.
+    """
+    abs_path = os.path.abspath(data_path)
+    manifest_fname = SCAN_MANIFEST_FNAME.format(
+        hashlib.sha1(abs_path.encode()).hexdigest()[:16])
+    try:
+        manifest = read_json(CACHE_DIR, manifest_fname)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if (manifest.get("version") != SCAN_MANIFEST_VERSION 
+        or manifest.get("data_path") != abs_path):
+        manifest = {"version": SCAN_MANIFEST_VERSION, "data_path": abs_path, 
+                    "mtime": None, "day_names": [], "days": {}}
+
+    root_mtime = os.stat(data_path).st_mtime_ns
+    if root_mtime != manifest["mtime"]:
+        with os.scandir(data_path) as entries:
+            manifest["day_names"] = sorted(e.name for e in entries if e.is_dir()
+                                           and e.name not in SCAN_SKIP_DIRS)
+        manifest["mtime"] = root_mtime
+        manifest["days"] = {day: entry for day, entry in manifest["days"].items()
+                            if day in manifest["day_names"]}
+
+    tree = {}
+    for day in manifest["day_names"]:
+        if day in exclude_days or (only_days and day not in only_days):
+            continue
+        day_entry = _scan_dir(os.path.join(data_path, day), manifest["days"].get(day))
+        manifest["days"][day] = day_entry
+        tree[day] = {session: sess_entry["preproc_dirs"] for session, sess_entry 
+                     in sorted(day_entry["sessions"].items())}
+    
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_fname = f"{manifest_fname}.{os.getpid()}.tmp"
+        write_dict2json(manifest, CACHE_DIR, tmp_fname)
+        os.replace(os.path.join(CACHE_DIR, tmp_fname), 
+                   os.path.join(CACHE_DIR, manifest_fname))
+    except OSError as e:
+        logger.warning(f"{e} Scan manifest won't be saved.")
+    return tree
+
+def _scan_dir(day_path, cached):
+    # sessions of a day and their preproc directories, cached entries of
+    # unchanged directories are reused
+    mtime = os.stat(day_path).st_mtime_ns
+    if cached is not None and cached["mtime"] == mtime:
+        session_mtimes = {session: os.stat(os.path.join(day_path, session)).st_mtime_ns
+                          for session in cached["sessions"]}
+    else:
+        with os.scandir(day_path) as entries:
+            # the stat results of scandir entries are cached
+            session_mtimes = {e.name: e.stat().st_mtime_ns for e in entries if e.is_dir()}
+
+    cached_sessions = cached["sessions"] if cached is not None else {}
+    sessions = {}
+    for session, session_mtime in session_mtimes.items():
+        cached_session = cached_sessions.get(session)
+        if cached_session is not None and cached_session["mtime"] == session_mtime:
+            sessions[session] = cached_session
+            continue
+        with os.scandir(os.path.join(day_path, session)) as entries:
+            preproc_dirs = sorted(e.name for e in entries if e.is_dir()
+                                  and e.name.startswith(PREPROC_DIR_PREFIX))
+        sessions[session] = {"mtime": session_mtime, "preproc_dirs": preproc_dirs}
+    return {"mtime": mtime, "sessions": sessions}
+
+def get_stale_preproc_stages(data_path, preproc_path, metad, logger):
+    """
+    Compare the manifest of a preproc directory with the current raw files and
+    metadata, return the stages that need to be recomputed. A raw file with a
+    different size changed, one with only a different mtime is hashed. If the
+    content is unchanged, the new mtime is written back to the manifest, so 
+    the file isn't hashed again by the next run.
+    """
+    manifest = read_preproc_manifest(preproc_path) if preproc_path else None
+    if manifest is None:
+        logger.info("No valid preprocessing manifest found, processing all stages.")
+        return list(PREPROC_STAGES)
+    if manifest["version"] != PREPROC_VERSION:
+        logger.info((f"Preprocessing version changed ({manifest['version']} -> "
+                     f"{PREPROC_VERSION}), processing all stages."))
+        return list(PREPROC_STAGES)
+
+    stale_stages = []
+    fingerprints = {}  # of touched raw files, hashed once
+    touched = False
+    for stage, stage_def in PREPROC_STAGES.items():
+        stage_manifest = manifest["stages"].get(stage)
+        if stage_manifest is None:
+            stale_stages.append(stage)
+            continue
+        
+        params = {p: metad.get(p) for p in stage_def["params"]}
+        params_changed = params != stage_manifest["params"]
+        inputs_changed = False
+        for fn in stage_def["inputs"]:
+            old_fp = stage_manifest["inputs"].get(fn)
+            full_fname = os.path.join(data_path, fn)
+            if old_fp is None or not os.path.exists(full_fname):
+                inputs_changed |= (old_fp is not None) or os.path.exists(full_fname)
+                continue
+            stat = os.stat(full_fname)
+            if stat.st_size != old_fp["size"]:
+                inputs_changed = True
+            elif stat.st_mtime != old_fp["mtime"]:
+                if fn not in fingerprints:
+                    fingerprints[fn] = fingerprint_file(full_fname)
+                if fingerprints[fn]["hash"] != old_fp["hash"]:
+                    inputs_changed = True
+                else:
+                    stage_manifest["inputs"][fn] = fingerprints[fn]
+                    touched = True
+        outputs_missing = not all(preproc_output_exists(preproc_path, fn)
+                                  for fn in stage_def["outputs"] 
+                                  if manifest["outputs"].get(fn))
+
+        if params_changed or inputs_changed or outputs_missing:
+            stale_stages.append(stage)
+    
+    if touched:
+        try:
+            write_dict2json(manifest, preproc_path, PREPROC_MANIFEST_FNAME)
+        except OSError as e:
+            logger.warning(f"{e} Updated raw file mtimes won't be saved.")
+    if stale_stages:
+        logger.info(f"Stale preprocessing stages: {', '.join(stale_stages)}")
+    return stale_stages
+
+def read_session_catalog(data_path):
+    try:
+        catalog = pd.read_csv(os.path.join(data_path, SESSION_CATALOG_FNAME),
+                              parse_dates=["session_start", "session_stop"])
+    except FileNotFoundError:
+        return None
+    catalog["session_length"] = pd.to_timedelta(catalog["session_length"])
+    catalog["streams"] = catalog["streams"].fillna("")
+    return catalog
+
+def write_session_catalog(catalog, data_path):
+    catalog_fname = os.path.join(data_path, SESSION_CATALOG_FNAME)
+    catalog.to_csv(catalog_fname+".tmp", index=False)
+    os.replace(catalog_fname+".tmp", catalog_fname)
+
+def list_dataset_partitions(store_path, exclude_days=(), only_days=(), 
+                            start_date=None, end_date=None):
+    """
+    Day partitions of a dataset store that pass the day filters, without 
+    listing the sessions of the other days.
+
+    Args:
+    - store_path (str): Dataset store directory.
+    - exclude_days, only_days (list): Day directory names (YYYY-MM-DD).
+    - start_date, end_date (str, optional): Inclusive date range, days one 
+      day outside are kept as sessions can start after midnight.
+
+    Returns:
+    - dict: Day name -> list of session partition paths, sorted.
+    """
+    start = pd.Timestamp(start_date) -pd.Timedelta(days=1) if start_date else None
+    end = pd.Timestamp(end_date) +pd.Timedelta(days=1) if end_date else None
+    partitions = {}
+    for day in sorted(os.listdir(store_path)):
+        day_path = os.path.join(store_path, day)
+        if (not os.path.isdir(day_path) or day in exclude_days 
+            or (only_days and day not in only_days)):
+            continue
+        day_date = pd.to_datetime(day, format="%Y-%m-%d", errors='coerce')
+        if ((start is not None and not day_date >= start) 
+            or (end is not None and not day_date <= end)):
+            continue
+        partitions[day] = [os.path.join(day_path, sd) for sd in sorted(os.listdir(day_path))
+                           if os.path.exists(os.path.join(day_path, sd, 
+                                                          DATASET_STORE_SESSION_FNAME))]
+    return partitions
+
+def load_prepoc_data(data_path, logger, preproc_path=None):
     logger.info("Loading preprocessed data.")
-    prerpoc_path = [os.path.join(data_path,el) for el in os.listdir(data_path) 
-                            if os.path.isdir(os.path.join(data_path,el))][0]
+    if preproc_path is None:
+        preproc_path = find_preproc_dir(data_path)
     fnames = (EXPFRAME_TS_OUTFNAME, LICK_OUTFNAME, DIST_LEFT_OUTFNAME, 
               REWARD_OUTFNAME, ONOFF_OUTFNAME, FRONTCAM_TS_OUTFNAME, SCENECAM_TS_OUTFNAME, 
               FACECAM_TS_OUTFNAME)
-    return [read_pkl(prerpoc_path, fn, logger) for fn in fnames]
\ No newline at end of file
+    return [read_preproc_data(preproc_path, fn, logger) for fn in fnames]
\ No newline at end of file
@@ -1,66 +1,306 @@
 import os
 import json
+import time
+import calendar
 import pandas as pd
 import numpy as np
 from datetime import timedelta as datetime_timedelta
 
-from .video_utils import open_video
-from .video_utils import get_frame_count
-from .video_utils import release_cap
+from .video_utils import probe_video
 
 def unix2pd_datetime(tstamps, unit="s"):
     datetimes = pd.to_datetime(tstamps, unit=unit, origin='unix', errors='coerce')
     return datetimes
 
+def local_datetime2unix(datetimes):
+    # vectorized time.mktime, the UTC offset of the local timezone is looked 
+    # up once per distinct second, exact on DST switch days
+    datetimes = pd.Series(datetimes)
+    seconds = datetimes.dt.floor("s")
+    utc_offsets = {sec: time.mktime(sec.timetuple()) - calendar.timegm(sec.timetuple())
+                   for sec in seconds.unique()}
+    naive_unix = datetime2ns(datetimes.values) / 1e9
+    return naive_unix + seconds.map(utc_offsets).values.astype(float)
+
 def pdTimetelta2datetimeTimedelta(pd_deltatime):
     days = pd_deltatime.days
     seconds = pd_deltatime.seconds
     mseconds = pd_deltatime.microseconds
     return datetime_timedelta(days=days, seconds=seconds, microseconds=mseconds)
 
-def check_negative_deltatimes(times, logger):
-    deltatimes = np.insert(np.diff(times), 0, np.nan)
-    neg_deltatimes_mask = deltatimes<0
+def datetime2ns(datetimes):
+    # int64 nanoseconds since epoch, independent of the pandas resolution
+    return np.asarray(datetimes, dtype='datetime64[ns]').view(np.int64)
+
+def get_interval_overlaps(starts, ends, ev_starts, ev_ends=None):
+    """
+    Check for every interval (start, end) if any event overlaps with it.
+
+    An interval overlaps with an event if the event starts inside the interval,
+    ends inside the interval, or spans the whole interval (all comparisons
+    strict). Point events (e.g. rewards) are passed without `ev_ends`. Runs in
+    O((n_intervals + n_events) log n_events) using sorted arrays.
+
+    Args:
+    - starts, ends (array-like): Interval boundaries, datetime64 or int64 ns.
+    - ev_starts, ev_ends (array-like): Event boundaries, datetime64 or int64 ns.
+
+    Returns:
+    - np.ndarray: Boolean mask of length n_intervals.
+    """
+    starts, ends = datetime2ns(starts), datetime2ns(ends)
+    ev_starts = datetime2ns(ev_starts)
+    ev_ends = ev_starts if ev_ends is None else datetime2ns(ev_ends)
+
+    order = np.argsort(ev_starts, kind='stable')
+    ev_starts, ev_ends = ev_starts[order], ev_ends[order]
+    sorted_ev_ends = np.sort(ev_ends)
+
+    def any_within(ev_tstamps):
+        # events with start < t < end
+        n_before_end = np.searchsorted(ev_tstamps, ends, side='left')
+        n_upto_start = np.searchsorted(ev_tstamps, starts, side='right')
+        return n_before_end > n_upto_start
+
+    overlaps = any_within(ev_starts) | any_within(sorted_ev_ends)
+    if ev_starts.size:
+        # events starting before the interval, longest reaching end among them
+        max_ev_end = np.maximum.accumulate(ev_ends)
+        n_started = np.searchsorted(ev_starts, starts, side='left')
+        started = n_started > 0
+        spanning = np.zeros_like(overlaps)
+        spanning[started] = max_ev_end[n_started[started]-1] > ends[started]
+        overlaps |= spanning
+    return overlaps
+
+def asof_indices(tstamps, ref_tstamps, direction="backward", strict=False):
+    """
+    Sorted asof join: for every timestamp the index of the last reference
+    timestamp at or before it (`backward`) or of the closest one (`nearest`).
+
+    Args:
+    - tstamps (array-like): Timestamps to look up, datetime64 or int64 ns.
+    - ref_tstamps (array-like): Reference timestamps, need not be sorted.
+    - direction (str): `backward` or `nearest`.
+    - strict (bool): With `backward`, only reference timestamps strictly before.
+
+    Returns:
+    - np.ndarray: int64 indices into `ref_tstamps`, -1 where there is none.
+    """
+    tstamps, ref_tstamps = datetime2ns(tstamps), datetime2ns(ref_tstamps)
+    if not ref_tstamps.size:
+        return np.full(tstamps.size, -1, dtype=np.int64)
+    order = None
+    if np.any(ref_tstamps[1:] < ref_tstamps[:-1]):
+        order = np.argsort(ref_tstamps, kind='stable')
+        ref_tstamps = ref_tstamps[order]
+
+    side = 'left' if strict and direction == "backward" else 'right'
+    idx = np.searchsorted(ref_tstamps, tstamps, side=side) -1
+    if direction == "nearest":
+        after = np.minimum(idx+1, ref_tstamps.size-1)
+        before = np.maximum(idx, 0)
+        after_closer = np.abs(ref_tstamps[after]-tstamps) < np.abs(tstamps-ref_tstamps[before])
+        idx = np.where((idx < 0) | after_closer, after, before)
+    elif direction != "backward":
+        raise ValueError(f"Invalid direction `{direction}`, valid are `backward`, `nearest`")
     
-    if neg_deltatimes_mask.any():
-        n_negs = sum(neg_deltatimes_mask)
-        logger.warning([f"{n_negs} negative timedeltas detected [s]",
-                        "These values will be removed:",
-                        str(deltatimes[neg_deltatimes_mask])])
-    return neg_deltatimes_mask
-
-def check_timeseries_integrity(times, logger):
-    deltatimes = times.index.to_series().diff().dt.total_seconds() *1e3
-    med, std = np.nanmedian(deltatimes), np.nanstd(deltatimes)
-    within_delta = lambda d, delta: (d<med+(delta)) & (d>max(med-delta, 0))
+    if order is not None:
+        idx = np.where(idx >= 0, order[np.maximum(idx, 0)], -1)
+    return idx.astype(np.int64)
+
+def rolling_time_filter(data, window, how="mean", carry=None):
+    """
+    Trailing time-window filter for irregularly sampled data.
+
+    Every output sample is the mean, median or min of the input samples in 
+    (t-window, t]. Uses pandas offset-based rolling windows, which run in a 
+    single pass (running sums for the mean, a monotonic deque for the min, a
+    skiplist for the median). Long streams can be filtered chunk by chunk by 
+    passing the returned carry (the last window of samples) to the next call.
+
+    Args:
+    - data (pd.Series): Samples with a monotonically increasing DatetimeIndex.
+    - window (pd.Timedelta): Window length.
+    - how (str): `mean`, `median` or `min`.
+    - carry (pd.Series, optional): Carry returned by the call on the previous chunk.
+
+    Returns:
+    - tuple: float32 np.ndarray of filtered values aligned with `data`, carry 
+      for the next chunk.
+    """
+    if how not in ("mean", "median", "min"):
+        raise ValueError(f"Invalid filter `{how}`, valid are `mean`, `median`, `min`")
+    n_carry = 0
+    if carry is not None and len(carry):
+        n_carry = len(carry)
+        data = pd.concat([carry, data])
+    if data.empty:
+        return np.empty(0, dtype=np.float32), carry
     
-    one_ms = within_delta(deltatimes, 1)
-    one_stds = within_delta(deltatimes, std*1)
-    two_stds = within_delta(deltatimes, std*2)
-    three_stds = within_delta(deltatimes, std*3)
-    ood = ~three_stds
-
-    msg = []
-    msg.append(f"Median: {med:.3f}, STD: {std:.3f}")
-    msg.append((f"Within 1 ms ({max(med-1,0):.3f} ms - {med+1:.3f} ms):"
-                f" {one_ms.sum()*100/len(times):.1f}%"))
-    msg.append((f"Within 1 STD ({max(med-1*std,0):.3f} ms - {med+1*std:.3f} ms):"
-                f" {one_stds.sum()*100/len(times):.1f}%"))
-    msg.append((f"Within 2 STD ({max(med-2*std,0):.3f} ms - {med+2*std:.3f} ms):"
-                f" {two_stds.sum()*100/len(times):.1f}%"))
-    msg.append((f"Within 3 STD ({max(med-3*std,0):.3f} ms - {med+3*std:.3f} ms):"
-                f" {three_stds.sum()*100/len(times):.1f}%"))
-    msg.append(f"Out of distribution deltatimes: {ood.sum()}")
-    # if config.LOG_OOD_DELTATIMES:
-    #     msg.append(f"Out of distribution deltatimes:\n{deltatimes[ood]}")
-    logger.info(msg)
+    filtered = getattr(data.rolling(window, min_periods=1), how)()
+    filtered = filtered.values[n_carry:].astype(np.float32)
+    carry = data[data.index > data.index[-1] -window]
+    return filtered, carry
+
+def detect_threshold_edges(t, values, block_ns, hysteresis, min_amplitude, 
+                           carry=None, last_chunk=True):
+    """
+    Rising and falling edges of a two-level signal (e.g. a photoresistor on a
+    flashing screen patch) with an adaptive threshold and hysteresis.
+
+    The signal is split into blocks of `block_ns`, the threshold of a block is
+    the midpoint of its min and max. A sample counts as high above midpoint + 
+    hysteresis *half range, as low below midpoint - hysteresis *half range, 
+    in between it keeps the previous state. Blocks with a range below 
+    `min_amplitude` (e.g. screen off) keep the state. Works chunk by chunk: 
+    the samples of the last, possibly incomplete block and the state are 
+    carried to the next call, the result doesn't depend on the chunk size.
+
+    Args:
+    - t (np.ndarray): Sorted timestamps, int64 ns.
+    - values (np.ndarray): Signal values.
+    - block_ns (int): Block length in ns.
+    - hysteresis (float): Hysteresis as a fraction of the half range.
+    - min_amplitude (float): Minimum block range to detect edges.
+    - carry (tuple, optional): Carry returned by the call on the previous chunk.
+    - last_chunk (bool): Whether this is the last chunk, nothing is carried.
+
+    Returns:
+    - tuple: Timestamps of rising edges, of falling edges (int64 ns), carry.
+    """
+    state = 0  # unknown
+    if carry is not None:
+        carry_t, carry_values, state = carry
+        t = np.concatenate([carry_t, t])
+        values = np.concatenate([carry_values, values])
+    
+    if not len(t):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), (t, values, state)
+    block = t //block_ns
+    cut = len(t) if last_chunk else np.searchsorted(block, block[-1], side='left')
+    carry = (t[cut:], values[cut:], state)
+    t, values, block = t[:cut], values[:cut], block[:cut]
+    if not len(t):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), carry
+
+    block_starts = np.flatnonzero(np.diff(block, prepend=block[0]-1))
+    block_sizes = np.diff(np.append(block_starts, len(t)))
+    block_min = np.minimum.reduceat(values, block_starts).astype(np.float64)
+    block_max = np.maximum.reduceat(values, block_starts).astype(np.float64)
+    mid = np.repeat((block_max+block_min) /2, block_sizes)
+    half_range = np.repeat((block_max-block_min) /2, block_sizes)
+    valid = half_range*2 >= min_amplitude
+
+    mark = np.zeros(len(t), dtype=np.int8)
+    mark[valid & (values > mid +hysteresis*half_range)] = 1
+    mark[valid & (values < mid -hysteresis*half_range)] = -1
+    # forward fill the marks -> state of every sample
+    last_mark = np.maximum.accumulate(np.where(mark != 0, np.arange(len(t)), -1))
+    states = np.where(last_mark >= 0, mark[np.maximum(last_mark, 0)], state)
+    prev_states = np.concatenate([[state], states[:-1]])
+    rising = t[(states == 1) & (prev_states == -1)]
+    falling = t[(states == -1) & (prev_states == 1)]
+    carry = (carry[0], carry[1], states[-1])
+    return rising, falling, carry
+
+def pair_edges(rising, falling, debounce_ns=0):
+    """
+    Pair rising and falling edges to (start, end) intervals of the high state.
+    Gaps shorter than `debounce_ns` are merged, then intervals shorter than 
+    `debounce_ns` dropped.
+
+    Args:
+    - rising, falling (np.ndarray): Alternating edge timestamps, int64 ns.
+    - debounce_ns (int): Minimum gap and interval length.
+
+    Returns:
+    - tuple: Interval starts and ends.
+    """
+    if len(falling) and len(rising) and falling[0] < rising[0]:
+        falling = falling[1:]
+    n = min(len(rising), len(falling))
+    starts, ends = rising[:n], falling[:n]
+    if not n or not debounce_ns:
+        return starts, ends
+    
+    new_interval = np.concatenate([[True], starts[1:] -ends[:-1] >= debounce_ns])
+    last_in_group = np.append(new_interval[1:], True)
+    starts, ends = starts[new_interval], ends[last_in_group]
+    long_enough = ends -starts >= debounce_ns
+    return starts[long_enough], ends[long_enough]
+
+def binary_intervals(t, values, carry=None):
+    """
+    Intervals in which a 0/1 signal (e.g. the lick sensor) is 1. An interval
+    starts at its first 1 sample and ends at its last 1 sample, the signal is
+    taken to start at 0. Works chunk by chunk: an interval that is still open
+    at the end of a chunk is carried to the next call.
+
+    Args:
+    - t (np.ndarray): Sorted timestamps, int64 ns.
+    - values (np.ndarray): Signal values.
+    - carry (tuple, optional): Carry returned by the call on the previous chunk.
+
+    Returns:
+    - tuple: Interval starts, ends (int64 ns), carry.
+    """
+    if carry is None:
+        carry = (None, 0, None)
+    prev_t, prev_value, open_start = carry
+    if not len(t):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), carry
+    
+    values = np.asarray(values).astype(int)
+    if prev_t is None:
+        # sessions start with no lick
+        values[0] = 0
+        prev_t = t[0]
+    switch = np.diff(values, prepend=prev_value)
+    starts = t[switch == 1]
+    ends = np.concatenate([[prev_t], t[:-1]])[switch == -1]
+    if open_start is not None:
+        starts = np.concatenate([[open_start], starts])
+    open_start = starts[-1] if len(starts) > len(ends) else None
+    return starts[:len(ends)], ends, (t[-1], values[-1], open_start)
+
+def intervals2frame(starts, ends):
+    # interval table of int64 ns starts and ends
+    frame = pd.DataFrame({"start": np.asarray(starts).view("datetime64[ns]"),
+                          "end": np.asarray(ends).view("datetime64[ns]")})
+    frame['duration'] = frame['end']-frame['start']
+    return frame
+
+def frame_intervals(frame_ts, fps):
+    # camera frame table, a frame lasts until the next one starts
+    frame_data = {"start":frame_ts}
+    frame_ts_end = np.roll(frame_data["start"].values, -1)
+    frame_deltat = pd.Timedelta(seconds=1/fps)
+    frame_ts_end[-1] = frame_ts_end[-2] + frame_deltat
+    frame_data["end"] = frame_ts_end
+    
+    frame_data = pd.DataFrame(frame_data)
+    frame_data['duration'] = frame_data['end']-frame_data['start']
+    return frame_data
+
+def filter_session_catalog(catalog, min_length=None, start_date=None, 
+                           end_date=None, min_rewards_per_min=None):
+    # boolean mask of catalog rows matching all given filters, dates inclusive
+    mask = pd.Series(True, index=catalog.index)
+    if min_length is not None:
+        mask &= catalog.session_length > pd.Timedelta(min_length)
+    if start_date is not None:
+        mask &= catalog.session_start >= pd.Timestamp(start_date)
+    if end_date is not None:
+        mask &= catalog.session_start < pd.Timestamp(end_date) + pd.Timedelta(days=1)
+    if min_rewards_per_min is not None:
+        mask &= catalog.reward_events_per_min >= min_rewards_per_min
+    return mask
 
 def check_video_ts_match(frame_tstamps, vid_fname, logger):
-    vid_cap = open_video(vid_fname, logger)
-    vid_nframes = get_frame_count(vid_cap)
+    vid_nframes = probe_video(vid_fname, logger)["frame_count"]
     n_frame_ts = frame_tstamps.shape[0]
     if vid_nframes != n_frame_ts:
         logger.warning(f"{vid_fname}:\nVideo has {vid_nframes} frames"
                        f", but timestamp file has {n_frame_ts} entries.\n"
-                       f"Processing will assume matching 0-indices.")
-    release_cap(vid_cap)
\ No newline at end of file
+                       f"Processing will assume matching 0-indices.")
\ No newline at end of file
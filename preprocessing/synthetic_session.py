@@ -0,0 +1,108 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+
+from .data_io import write_dict2json
+
+from general_modules.config import *
+
+def write_synthetic_session(dest_path, length_min=10, sensor_rate_hz=1000,
+                            camera_fps=30, frame_size=(360, 480), seed=0):
+    """
+    Write a synthetic session directory with the same files as a recording.
+
+    Creates `sensor_data.csv` (photoresistor, lick and distance sensor
+    interleaved), `reward.log` with ON/OFF lines, the three frameGrabber
+    timestamp files, small camera videos and `metadata.json`. Useful for
+    benchmarking preprocessing without access to the NAS data.
+
+    Args:
+    - dest_path (str): Session directory, e.g. `<data>/2023-10-05/09-00-00`,
+      the session starts at this date and time.
+    - length_min (float): Session length in minutes.
+    - sensor_rate_hz (int): Samples per second for each of the three sensors.
+    - camera_fps (int): Frame rate of the three cameras.
+    - frame_size (tuple): Video (height, width), must contain FACE_CAM_CROP.
+    - seed (int): Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(dest_path, exist_ok=True)
+    length_s = length_min*60
+    # the session starts at the date and time of the session directory
+    start_date, start_time = dest_path.rstrip(os.path.sep).split(os.path.sep)[-2:]
+    t0 = pd.to_datetime(f"{start_date} {start_time}", format="%Y-%m-%d %H-%M-%S").timestamp()
+
+    _write_sensor_file(dest_path, rng, t0, length_s, sensor_rate_hz)
+    reward_tstamps = _write_reward_file(dest_path, rng, t0, length_s)
+    for ts_fname, vid_fname in ((FRONT_CAM_TS_FNAME, FRONT_CAM_FNAME),
+                                (SCENE_CAM_TS_FNAME, SCENE_CAM_FNAME),
+                                (FACE_CAM_TS_FNAME, FACE_CAM_FNAME)):
+        _write_camera_files(dest_path, ts_fname, vid_fname, rng, t0, length_s,
+                            camera_fps, frame_size)
+
+    metad = {"rewardVolume": 40, "interRewardInterval": 3, "distanceLimit": 6,
+             "cameraFPS": camera_fps, "session_start_date": start_date,
+             "session_start_time": start_time, "dist_sensor_mean_windowsize": 10,
+             "notes": f"synthetic session, {len(reward_tstamps)} rewards"}
+    write_dict2json(metad, dest_path, "metadata.json")
+
+def _write_sensor_file(dest_path, rng, t0, length_s, sensor_rate_hz):
+    n = int(length_s*sensor_rate_hz)
+    tstamps = t0 + np.sort(rng.uniform(0, length_s, n))
+
+    # photoresistor: flickering screen, lick: bursts of contact, distance:
+    # slow drift of the animal towards and away from the sensor
+    photores = 800 + 40*((tstamps*60).astype(int) %2) + rng.integers(0, 5, n)
+    lick = (np.sin(tstamps/1.3) + rng.normal(0, .05, n) > .9).astype(int)
+    distance = np.round(np.abs(8 + 6*np.sin(tstamps/20) + rng.normal(0, .3, n)), 2)
+
+    ids = np.repeat([PHTOTRES_SENSOR_ID, LICK_SENSOR_ID, DISTANCELEFT_SENSOR_ID], n)
+    values = np.concatenate([photores, lick, distance])
+    all_tstamps = np.concatenate([tstamps, tstamps+1e-4, tstamps+2e-4])
+    order = np.argsort(all_tstamps, kind='stable')
+
+    sensor_d = pd.DataFrame({"id": ids[order], "value": values[order],
+                             "arduino_timestamp": np.arange(3*n),
+                             "computer_timestamp": all_tstamps[order],
+                             "logging_timestamp": all_tstamps[order]})
+    sen_filename = os.path.join(dest_path, SENSOR_DATA_FNAME)
+    sensor_d.to_csv(sen_filename, index=False, float_format="%.7f")
+    # a recording that is still running ends with a partial line
+    with open(sen_filename, 'a') as file:
+        file.write(f"{LICK_SENSOR_ID},0,{3*n}")
+
+def _write_reward_file(dest_path, rng, t0, length_s):
+    reward_tstamps = t0 + np.cumsum(rng.uniform(3, 30, int(length_s/3)))
+    reward_tstamps = reward_tstamps[reward_tstamps < t0+length_s]
+    to_str = lambda t: pd.Timestamp(t, unit='s').strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
+
+    lines = [f"{to_str(t0)} - INFO - ON"]
+    lines.extend(f"{to_str(t)} - INFO - Reward delivered {t:.7f}" for t in reward_tstamps)
+    lines.append(f"{to_str(t0+length_s)} - INFO - OFF")
+    with open(os.path.join(dest_path, REWARD_DATA_FNAME), 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    return reward_tstamps
+
+def _write_camera_files(dest_path, ts_fname, vid_fname, rng, t0, length_s,
+                        camera_fps, frame_size):
+    n_frames = int(length_s*camera_fps)
+    tstamps = t0 + np.arange(n_frames)/camera_fps + rng.uniform(0, 2e-3, n_frames)
+    pd.DataFrame({"frame": np.arange(n_frames), "t": tstamps}).to_csv(
+        os.path.join(dest_path, ts_fname), sep=" ", header=False, index=False,
+        float_format="%.7f")
+
+    height, width = frame_size
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(os.path.join(dest_path, vid_fname), fourcc, camera_fps,
+                          (width, height))
+    # flat background with a moving marker, compresses to a few MB per hour
+    background = np.full((height, width, 3), 90, dtype=np.uint8)
+    size = height //8
+    for i in range(n_frames):
+        frame = background.copy()
+        x = i*4 %(width-size)
+        y = (height-size) //2
+        frame[y:y+size, x:x+size] = 230
+        out.write(frame)
+    out.release()
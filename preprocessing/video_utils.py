@@ -1,15 +1,124 @@
 import cv2
 import os
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
 from general_modules.config import *
 
+_probe_cache = None
+_probe_cache_lock = threading.Lock()
+
 def check_video_file(video_file, logger):
+    probe = probe_video(video_file, logger)
+    if probe is None or not probe["readable"]:
+        return False
+    if probe["corrupt"]:
+        logger.warning(f"{video_file} is truncated or corrupt, only the first "
+                       f"{probe['frame_count']} frames can be decoded.")
+    return True
+
+def probe_video(video_file, logger):
+    """
+    Get frame count, fps, duration and a truncated/corrupt flag of a video.
+
+    Results are cached on disk keyed by (path, size, mtime), a cache hit only
+    needs a stat of the file.
+
+    Args:
+    - video_file (str): Path to the video file.
+    - logger (CustomLogger): Logger for errors.
+
+    Returns:
+    - dict or None: Probe results, None if the file doesn't exist.
+    """
+    try:
+        stat = os.stat(video_file)
+    except FileNotFoundError:
+        logger.error(f"Could not find the video file: {video_file}")
+        return
+    
+    cache = _load_probe_cache()
+    key = os.path.abspath(video_file)
+    entry = cache.get(key)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+        return entry["probe"]
+    
+    probe = _probe_video_file(video_file, logger)
+    cache[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "probe": probe}
+    _save_probe_cache({key: cache[key]}, logger)
+    return probe
+
+def _probe_video_file(video_file, logger):
     vid_cap = open_video(video_file, logger)
+    if vid_cap is None:
+        return {"readable": False, "frame_count": 0, "fps": None, 
+                "duration": None, "corrupt": True}
+
+    fps = vid_cap.get(cv2.CAP_PROP_FPS)
+    # the container frame count is only an estimate, verify it by decoding 
+    # the last frame(s) instead of the whole video
+    est_count = get_frame_count(vid_cap)
+    corrupt = False
+    if est_count <= 0:
+        frame_count = 0
+        while vid_cap.read()[0]:
+            frame_count += 1
+    elif _read_frame_at(vid_cap, est_count-1):
+        frame_count = est_count
+        while vid_cap.read()[0]:
+            frame_count += 1
+    else:
+        # find the last decodable frame by bisection
+        lo, hi = -1, est_count-1
+        while hi-lo > 1:
+            mid = (lo+hi) //2
+            lo, hi = (mid, hi) if _read_frame_at(vid_cap, mid) else (lo, mid)
+        frame_count = lo+1
+        corrupt = True
     release_cap(vid_cap)
-    return vid_cap is not None
+
+    duration = frame_count/fps if fps else None
+    return {"readable": frame_count > 0, "frame_count": frame_count, "fps": fps, 
+            "duration": duration, "corrupt": corrupt}
+
+def _read_frame_at(vid_cap, frame_idx):
+    vid_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    return vid_cap.read()[0]
+
+def _load_probe_cache():
+    global _probe_cache
+    if _probe_cache is None:
+        try:
+            with open(os.path.join(CACHE_DIR, VIDEO_PROBE_CACHE_FNAME)) as file:
+                _probe_cache = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _probe_cache = {}
+    return _probe_cache
+
+def _save_probe_cache(new_entries, logger):
+    # merge with the file on disk, other processes might have written to it,
+    # the cameras are probed in concurrent threads
+    cache_fname = os.path.join(CACHE_DIR, VIDEO_PROBE_CACHE_FNAME)
+    with _probe_cache_lock:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            try:
+                with open(cache_fname) as file:
+                    cache = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                cache = {}
+            cache.update(new_entries)
+            tmp_fname = f"{cache_fname}.{os.getpid()}.tmp"
+            with open(tmp_fname, 'w') as file:
+                json.dump(cache, file)
+            os.replace(tmp_fname, cache_fname)
+        except OSError as e:
+            logger.warning(f"{e} Video probe cache won't be saved.")
     
 def open_video(video_file, logger):
     # Open the video file using OpenCV and return the video capture object.
@@ -47,40 +156,90 @@ def release_cap(vid_cap):
 def write_text(frame, text, xy, color=(255,255,255), font_scale=.8, 
                font_thickness=2):
     font = cv2.FONT_HERSHEY_SIMPLEX
-    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     cv2.putText(frame, text, xy, font, font_scale, color, font_thickness)
 
+def get_lookahead_flags(flags, n_frames):
+    # flags[i] = any(flags[i:i+n_frames]) via a cumulative sum
+    cum_flags = np.concatenate(([0], np.cumsum(flags)))
+    idx = np.arange(len(flags))
+    return cum_flags[np.minimum(idx+n_frames, len(flags))] > cum_flags[idx]
+
+def annotate_facecam_frame(frame, time_str, lick, reward):
+    x, y, width = FACE_CAM_CROP
+    frame = frame[x:x+width,y:y+width]
+    if FACE_CAM_FLIP:
+        frame = cv2.flip(frame, 0)
+    else:
+        frame = frame.copy()
+
+    write_text(frame, time_str, (120, 20), font_scale=.5, font_thickness=1)
+    if lick:
+        write_text(frame, "Lick", (10, width-13))
+    if reward:
+        write_text(frame, "Reward", (50, width-13), color=(0,255,0))
+    return frame
+
 def write_facecam_vid(vid_fname, frame_ts, lick_frames, reward_frames, 
-                      dest_path, output_fname, logger):
-    vid_cap = open_video(vid_fname, logger)
-    if frame_ts is None or vid_cap is None:
+                      dest_path, output_fname, logger, 
+                      n_workers=VIDEO_WRITER_N_WORKERS):
+    probe = probe_video(vid_fname, logger)
+    if frame_ts is None or probe is None or not probe["readable"]:
         logger.error("No annotated facecam video will be written.")
         return
+    vid_cap = open_video(vid_fname, logger)
     logger.info("Writing annotated facecamera video")
 
     fourcc = cv2.VideoWriter_fourcc(*'H264')
     x, y, width = FACE_CAM_CROP
-    fps = vid_cap.get(cv2.CAP_PROP_FPS)
+    fps = probe["fps"]
     dest_fname = os.path.join(dest_path, output_fname+VIDEO_FILE_ENDING)
     out = cv2.VideoWriter(dest_fname, fourcc, fps, (width, width))
 
-    last_reward_frame = -1
-    for i, ts in frame_ts.iterrows():
-        ret, frame = vid_cap.read()
-        if not ret:
-            break  
-
-        frame = frame[x:x+width,y:y+width]
-        frame = cv2.flip(frame, 0)
-
-        write_text(frame, ts.start.strftime('%H:%M:%S'), (120, 20), 
-                   font_scale=.5, font_thickness=1)
-        if lick_frames.iloc[i]:
-            write_text(frame, "Lick", (10, width-13))
-        if any(reward_frames.iloc[i:i+10]):
-            write_text(frame, "Reward", (50, width-13), color=(0,255,0))
+    # precompute the per-frame annotations, no annotation without the data
+    time_strs = frame_ts.start.dt.strftime('%H:%M:%S').values
+    no_flags = np.zeros(len(frame_ts), dtype=bool)
+    lick_flags = (np.asarray(lick_frames, dtype=bool) if lick_frames is not None 
+                  else no_flags)
+    reward_flags = get_lookahead_flags(np.asarray(reward_frames, dtype=bool) 
+                                       if reward_frames is not None else no_flags, 
+                                       REWARD_ANNOTATION_LOOKAHEAD)
 
-        out.write(frame)
+    # decode thread -> annotate workers -> encode (this thread), the bounded 
+    # queue of pending frames keeps the output order and limits memory
+    pending = queue.Queue(maxsize=VIDEO_WRITER_QUEUE_SIZE)
+    stop = threading.Event()
+    decode_errors = []
+    def decode(executor):
+        try:
+            for i in range(len(frame_ts)):
+                ret, frame = vid_cap.read()
+                if not ret or stop.is_set():
+                    break
+                pending.put(executor.submit(annotate_facecam_frame, frame, 
+                                            time_strs[i], lick_flags[i], 
+                                            reward_flags[i]))
+        except Exception as e:
+            decode_errors.append(e)
+        finally:
+            pending.put(None)
 
-    out.release()
-    release_cap(vid_cap)
\ No newline at end of file
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            decoder = threading.Thread(target=decode, args=(executor,), daemon=True)
+            decoder.start()
+            annotated = pending.get()
+            try:
+                while annotated is not None:
+                    out.write(annotated.result())
+                    annotated = pending.get()
+            finally:
+                # unblock the decoder if encoding failed
+                stop.set()
+                while annotated is not None:
+                    annotated = pending.get()
+                decoder.join()
+    finally:
+        out.release()
+        release_cap(vid_cap)
+    if decode_errors:
+        raise decode_errors[0]
\ No newline at end of file
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from preprocessing.MarmosetSessionData import MarmosetSessionData
+from preprocessing.data_utils import frame_intervals
+from preprocessing.data_utils import intervals2frame
+
+def _session(n_frames=90, fps=30):
+    # session with camera frames, no licks and no rewards
+    sess = MarmosetSessionData.__new__(MarmosetSessionData)
+    sess._preproc_path = None
+    sess.compact_streams = {}
+    start = pd.Timestamp("2023-10-05 09:00:00")
+    frame_ts = pd.Index(start + pd.to_timedelta(np.arange(n_frames)/fps, unit='s'))
+    sess.facecam_ts = frame_intervals(frame_ts, fps)
+    sess.frontcam_ts, sess.scenecam_ts = None, None
+    sess.dist_left_data, sess.expframe_ts_data = None, None
+    empty = np.empty(0, dtype=np.int64)
+    sess.lick_data = intervals2frame(empty, empty)
+    sess.reward_data = pd.Series(True, index=pd.DatetimeIndex(empty.view("datetime64[ns]")),
+                                 name="reward_events")
+    return sess
+
+def test_no_licks_no_rewards_with_alignment():
+    sess = _session()
+    alignment = sess._align_cam_frames("facecam")
+    lick_frames = sess._get_lickframes(sess.facecam_ts, alignment)
+    reward_frames = sess._get_rewardframes(sess.facecam_ts, alignment)
+    assert len(lick_frames) == len(reward_frames) == len(sess.facecam_ts)
+    assert not lick_frames.any() and not reward_frames.any()
+
+def test_no_licks_no_rewards_without_alignment():
+    sess = _session()
+    assert not sess._get_lickframes(sess.facecam_ts).any()
+    assert not sess._get_rewardframes(sess.facecam_ts).any()
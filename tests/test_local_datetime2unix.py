@@ -0,0 +1,22 @@
+import time
+import pandas as pd
+import pytest
+
+from preprocessing.data_utils import local_datetime2unix
+
+@pytest.fixture
+def berlin_tz(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Berlin")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+@pytest.mark.parametrize("day", ["2023-03-26", "2023-10-29"])
+def test_dst_switch_day_matches_mktime(berlin_tz, day):
+    # lines before, during and after the switch at 02:00/03:00
+    datetimes = pd.to_datetime([f"{day} {t}" for t in 
+                                ("00:15:00.250", "01:59:59.999", "02:30:00.500", 
+                                 "03:00:00.000", "09:00:00.125", "23:59:59.500")])
+    expected = [time.mktime(dt.timetuple()) + dt.microsecond/1e6 for dt in datetimes]
+    assert list(local_datetime2unix(datetimes)) == pytest.approx(expected, abs=1e-6)